@@ -15,6 +15,15 @@ STREAM_ANSWER = "STREAM_ANSWER"
 
 ERROR = "ERROR"
 
+# Data-link stream for commands and short answers. Each video is sent on a
+# stream of its own, so it never holds these up.
+CONTROL_STREAM = 0
+
+# Wire layout of a message header: one-byte command code, then the length of
+# the payload. The data-link layer fragments messages, so they need not fit in
+# one frame.
+MESSAGE_HEADER = struct.Struct("!cI")
+
 class ApplicationLayer(object):
     def __init__(self, datalink_layer):
         """
@@ -32,80 +41,98 @@ class ApplicationLayer(object):
             ERROR: 'E'
         }
 
-    def send(self, data):
+    def send(self, data, stream=CONTROL_STREAM):
         """
-        Send data to remote application.
+        Send data to remote application on a stream.
         """
 
-        self.datalink_layer.send(data)
+        self.datalink_layer.send(data, stream)
 
-    def recv(self, n):
+    def recv(self, n, stream=CONTROL_STREAM):
         """
-        Receive n bytes from remote application.
+        Receive n bytes from remote application on a stream.
         """
 
-        got = self.datalink_layer.recv(n)
+        got = self.datalink_layer.recv(n, stream)
         return got
 
-    def send_command(self, command_name, payload=''):
+    def recv_into(self, buf, n=None, stream=CONTROL_STREAM):
         """
-        Send the given command type, with the given payload.
+        Receive n bytes from remote application on a stream straight into
+        `buf`, or enough to fill it if n is not given.
         """
-        command_code = self.command_codes[command_name]
 
-        payload_len_unpacked = len(payload)
-        payload_len_packed = struct.pack("!B", payload_len_unpacked)
+        return self.datalink_layer.recv_into(buf, n, stream)
+
+    def send_command(self, command_name, payload='', stream=CONTROL_STREAM):
+        """
+        Send the given command type, with the given payload, on a stream.
+        """
+        command_code = self.command_codes[command_name]
 
-        full_packet = command_code + payload_len_packed + payload
-        self.send(full_packet)
+        full_packet = MESSAGE_HEADER.pack(command_code, len(payload)) + \
+                      payload
+        self.send(full_packet, stream)
         self.started = time.time()
 
-    def handle_one_command(self):
+    def handle_one_command(self, stream=CONTROL_STREAM):
         """
-        Receive and handle one command from the datalink layer.
+        Receive and handle one command from a stream of the datalink layer.
+        Returns False once the connection has ended.
         """
 
-        # First byte is command type.
-        command_type = self.recv(1)
-
-        # Next byte is length of payload.
-        payload_len_packed = self.recv(1)
-        payload_len_unpacked = struct.unpack("!B", payload_len_packed)[0]
+        # Header is the command type, then the length of the payload.
+        header = self.recv(MESSAGE_HEADER.size, stream)
+        if len(header) < MESSAGE_HEADER.size:
+            return False
+        command_type, payload_len_unpacked = MESSAGE_HEADER.unpack(header)
 
-        # Receive a payload if there is one.
+        # Receive a payload if there is one, reassembling its fragments
+        # directly into one buffer of the right size.
         payload = ''
         if payload_len_unpacked > 0:
-            payload = self.recv(payload_len_unpacked)
+            payload = bytearray(payload_len_unpacked)
+            if self.recv_into(payload, stream=stream) < payload_len_unpacked:
+                return False
 
-        # Pass the payload on to appropriate handler.
+        # Pass the payload on to appropriate handler, along with the stream
+        # to answer on.
         handler = self.command_handlers[command_type]
-        handler(payload)
+        handler(payload, stream)
+        return True
 
-    def receive_thread_func(self):
+    def receive_thread_func(self, stream=CONTROL_STREAM):
         """
-        Function for a dedicated receiver thread to run.
+        Function for a dedicated receiver thread to run on a stream.
         """
 
-        while True:
-            self.handle_one_command()
+        while self.handle_one_command(stream):
+            pass
 
-    def start_receive_thread(self):
+    def start_receive_thread(self, stream=CONTROL_STREAM):
         """
-        Start and daemonize a dedicated receiver thread.
+        Start and daemonize a dedicated receiver thread for a stream.
         """
 
-        receive_thread = threading.Thread(target=self.receive_thread_func)
+        receive_thread = threading.Thread(target=self.receive_thread_func,
+                                          args=(stream,))
         receive_thread.setDaemon(True)
         receive_thread.start()
 
 
 class ClientApplicationLayer(ApplicationLayer):
-    requesting_filename = "default.mov"
-    requesting_file = None
-
     def __init__(self, datalink_layer):
         super(ClientApplicationLayer, self).__init__(datalink_layer)
 
+        # Videos being received, by stream: the name requested, and the
+        # file being written once the first answer arrives.
+        self.transfers = {}
+
+        # Streams with a receiving thread, and the last one used for a
+        # video.
+        self.receiving_streams = set([CONTROL_STREAM])
+        self.last_stream = CONTROL_STREAM
+
         # Handler functions for different command codes.
         self.command_handlers = {
             'B': self.handle_LIST_ANSWER,
@@ -133,13 +160,27 @@ class ClientApplicationLayer(ApplicationLayer):
 
             elif "STREAM " in user_command:
                 payload = user_command[user_command.find(" ")+1:user_command.find("\n")]
-                self.requesting_filename = payload
-                self.send_command(STREAM_QUERY, payload)
+                stream = self.open_stream()
+                self.transfers[stream] = [payload, None]
+                self.send_command(STREAM_QUERY, payload, stream)
 
             else:
                 print "Available commands:\n  LIST\n  STREAM <videoname>"
 
-    def handle_LIST_ANSWER(self, payload):
+    def open_stream(self):
+        """
+        Pick the stream for the next video, and make sure something is
+        receiving on it. Streams are reused in turn.
+        """
+        self.last_stream = self.last_stream % MAX_STREAM + 1
+
+        if self.last_stream not in self.receiving_streams:
+            self.receiving_streams.add(self.last_stream)
+            self.start_receive_thread(self.last_stream)
+
+        return self.last_stream
+
+    def handle_LIST_ANSWER(self, payload, stream):
         """
         Handler for a LIST_ANSWER message the client receives.
         """
@@ -152,25 +193,28 @@ class ClientApplicationLayer(ApplicationLayer):
         else:
             print payload
 
-    def handle_STREAM_ANSWER(self, payload):
-        if self.requesting_file is None:
-            print "Saving as asciivids_%s..." % self.requesting_filename
-            self.requesting_file = open("asciivids_" + self.requesting_filename, 'w')
+    def handle_STREAM_ANSWER(self, payload, stream):
+        transfer = self.transfers[stream]
+        filename = transfer[0]
+
+        if transfer[1] is None:
+            print "Saving as asciivids_%s..." % filename
+            transfer[1] = open("asciivids_" + filename, 'w')
 
         if payload == "":
-            self.requesting_file.close()
-            self.requesting_file = None
+            transfer[1].close()
+            del self.transfers[stream]
             print "Done receiving asciivids_%s. Press any key to play." % \
-                  self.requesting_filename
-            playfile("asciivids_" + self.requesting_filename)
+                  filename
+            playfile("asciivids_" + filename)
 
         else:
-            self.requesting_file.write(payload)
+            transfer[1].write(payload)
 
-    def handle_ERROR(self, payload):
-        if self.requesting_file:
-            self.requesting_file.close()
-            self.requesting_file = None
+    def handle_ERROR(self, payload, stream):
+        transfer = self.transfers.pop(stream, None)
+        if transfer and transfer[1]:
+            transfer[1].close()
         print "ERROR from server: ", payload
 
 
@@ -186,26 +230,32 @@ class ServerApplicationLayer(ApplicationLayer):
 
         self.datalink_layer.is_client = False
 
-        # Main loop as server.
-        self.receive_thread_func()
+        # Main loop as server: serve commands on each stream the client
+        # opens from a thread of its own, so one video being sent doesn't
+        # hold up anything else. Returns once the client has gone.
+        while True:
+            stream = self.datalink_layer.accept_stream()
+            if stream is None:
+                return
+            self.start_receive_thread(stream)
 
-    def handle_LIST_QUERY(self, payload):
+    def handle_LIST_QUERY(self, payload, stream):
         """
         Handler for a LIST_QUERY message the server receives.
         """
-        self.send_command(LIST_ANSWER, "Available Videos:")
-        self.send_command(LIST_ANSWER, "starwars.mov")
+        self.send_command(LIST_ANSWER, "Available Videos:", stream)
+        self.send_command(LIST_ANSWER, "starwars.mov", stream)
 
-    def handle_STREAM_QUERY(self, payload):
+    def handle_STREAM_QUERY(self, payload, stream):
         try:
-            with open(payload, 'r') as f:
+            with open(str(payload), 'r') as f:
                 while True:
-                    got = f.read(128)
+                    got = f.read(STREAM_CHUNK_SIZE)
                     if got == "":
                         break
-                    self.send_command(STREAM_ANSWER, got)
-                self.send_command(STREAM_ANSWER)
+                    self.send_command(STREAM_ANSWER, got, stream)
+                self.send_command(STREAM_ANSWER, '', stream)
         except IOError:
-            self.send_command(ERROR, "Requested file not found.")
+            self.send_command(ERROR, "Requested file not found.", stream)
 
 
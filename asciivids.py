@@ -1,15 +1,137 @@
+import os
 import signal
 import argparse
+import itertools
 
-from physical import PhysicalLayer_Client, PhysicalLayer_Server
+from physical import PhysicalLayer_Client, Listener, adopt, \
+    PhysicalLayer_UDPClient, PhysicalLayer_UDPServer
 from datalink import DataLinkLayer_SR, DataLinkLayer_GBN
 from application import ClientApplicationLayer, ServerApplicationLayer
+from checksums import CHECKSUMS, CHECKSUM_PREFERENCE
+from handshake import Offer, open_datalink
+from impairment import Impairment, GilbertElliottLoss
+from sessions import SessionPool
+from reactor import reactor
+from metrics import MetricsExporter, registry
 from utils import *
 
 
 # Register sigint handler.
 signal.signal(signal.SIGINT, sigint_handle)
 
+
+def make_impairment(args, client_number=0):
+    """
+    Returns the impairment for one connection's physical layer.
+    """
+
+    # Frames are lost independently at the drop rate, or in bursts if
+    # asked. In a burst every frame is lost.
+    loss = None
+    if args.burst:
+        loss = GilbertElliottLoss(args.burst[0] / 100, args.burst[1] / 100,
+                                  good_loss=args.drop / 100.0)
+
+    seed = None if args.seed is None else args.seed + client_number
+
+    return Impairment(args.drop, args.corrupt, seed=seed, loss=loss,
+                      delay=args.delay, jitter=args.jitter,
+                      reorder_rate=args.reorder,
+                      reorder_delay=args.reorder_delay,
+                      bandwidth=args.bandwidth, bucket_size=args.bucket)
+
+
+def make_datalink(args, physical_layer):
+    """
+    Returns the data-link layer for one connection.
+    """
+
+    # By default the two ends agree on their data-link settings with a
+    # handshake: the best protocol and checksum both support, and the
+    # smaller of each limit. Options which only affect our own sending are
+    # not negotiated.
+    if not args.no_handshake:
+        offer = Offer(
+            protocols=['sr', 'gbn'] if args.sr else ['gbn'],
+            checksums=[args.checksum] if args.checksum
+                      else CHECKSUM_PREFERENCE,
+            max_frame_size=args.max_frame_size,
+            window_len=args.window or 0,
+            max_window=args.max_window or 0,
+            sack=not args.no_sack,
+            ack_delay=args.ack_delay)
+        return open_datalink(physical_layer, args.verbose, offer,
+                             adaptive_window=args.adaptive_window,
+                             dup_ack_threshold=args.dup_acks,
+                             fec_k=args.fec, fec_m=args.fec_parity)
+
+    # Data link layer only needs to know about the physical layer, which
+    # checksum to put on frames, how big frames and its window may be, and
+    # how long acks may wait.
+    datalink_options = {
+        'checksum': args.checksum or DEFAULT_CHECKSUM,
+        'max_frame_size': args.max_frame_size,
+        'max_window': args.max_window,
+        'adaptive_window': args.adaptive_window,
+        'ack_delay': args.ack_delay,
+        'fec_k': args.fec,
+        'fec_m': args.fec_parity
+    }
+    if args.window is not None:
+        datalink_options['window_len'] = args.window
+
+    # Different subclasses are implemented for SR and GBN.
+    if args.sr:
+        return DataLinkLayer_SR(physical_layer, args.verbose,
+                                sack=not args.no_sack, **datalink_options)
+    else:
+        return DataLinkLayer_GBN(physical_layer, args.verbose,
+                                 dup_ack_threshold=args.dup_acks,
+                                 **datalink_options)
+
+
+def start_metrics(args, process_number=0):
+    """
+    Export every connection's metrics, if asked. Each server process after
+    the first exports to the file name with its number added, or to the
+    port that many above.
+    """
+    if not args.metrics:
+        return
+
+    target = args.metrics
+    if process_number:
+        host, _, port = target.rpartition(':')
+        if host and port.isdigit():
+            target = '%s:%d' % (host, int(port) + process_number)
+        else:
+            target = '%s.%d' % (target, process_number)
+
+    MetricsExporter(registry, target, args.metrics_format,
+                    args.metrics_interval)
+
+
+def serve_session(args, sock, remote_addr, impairment, physical_options):
+    """
+    Serve one client until it goes away. The client's physical layer only
+    starts once a worker has taken it, so queued clients hold no threads.
+    """
+    physical_layer = adopt(sock, remote_addr, args.drop, args.corrupt,
+                           reactor=reactor if args.reactor else None,
+                           impairment=impairment, **physical_options)
+
+    # A client which goes away, or never finishes the handshake, mustn't
+    # leave its socket and threads behind.
+    try:
+        data_link = make_datalink(args, physical_layer)
+    except Exception as e:
+        physical_layer.close()
+        print "Client %s dropped: %s" % (str(remote_addr), e)
+        return
+
+    ServerApplicationLayer(data_link)
+    debug_log("Client %s has gone." % str(physical_layer.remote_addr))
+
 if __name__ == "__main__":
     # Parse command line args.
     p = argparse.ArgumentParser()
@@ -18,25 +140,92 @@ if __name__ == "__main__":
     p.add_argument('--corrupt', type=int, default=DEFAULT_CORRUPTION_RATE)
     p.add_argument('--sr', action='store_true')
     p.add_argument('--verbose', action='store_true')
+    p.add_argument('--flush-bytes', type=int, default=DEFAULT_FLUSH_BYTES)
+    p.add_argument('--flush-delay', type=float, default=DEFAULT_FLUSH_DELAY)
+    p.add_argument('--nagle', action='store_true')
+    p.add_argument('--udp', action='store_true')
+    p.add_argument('--checksum', choices=sorted(CHECKSUMS))
+    p.add_argument('--max-frame-size', type=int,
+                   default=DEFAULT_MAX_FRAME_SIZE)
+    p.add_argument('--window', type=int)
+    p.add_argument('--max-window', type=int)
+    p.add_argument('--adaptive-window', action='store_true')
+    p.add_argument('--dup-acks', type=int, default=DUP_ACK_THRESHOLD)
+    p.add_argument('--no-sack', action='store_true')
+    p.add_argument('--ack-delay', type=float, default=DEFAULT_ACK_DELAY)
+    p.add_argument('--no-handshake', action='store_true')
+    p.add_argument('--fec', type=int, default=0)
+    p.add_argument('--fec-parity', type=int, default=DEFAULT_FEC_PARITY)
+    p.add_argument('--seed', type=int)
+    p.add_argument('--burst', type=float, nargs=2, metavar=('P', 'R'))
+    p.add_argument('--delay', type=float, default=0.0)
+    p.add_argument('--jitter', type=float, default=0.0)
+    p.add_argument('--reorder', type=int, default=0)
+    p.add_argument('--reorder-delay', type=float,
+                   default=DEFAULT_REORDER_DELAY)
+    p.add_argument('--bandwidth', type=int, default=0)
+    p.add_argument('--bucket', type=int, default=0)
+
+    p.add_argument('--max-sessions', type=int, default=DEFAULT_MAX_SESSIONS)
+    p.add_argument('--processes', type=int, default=1)
+    p.add_argument('--reactor', action='store_true')
+
+    p.add_argument('--metrics')
+    p.add_argument('--metrics-format', choices=['prometheus', 'json'],
+                   default='prometheus')
+    p.add_argument('--metrics-interval', type=float,
+                   default=DEFAULT_METRICS_INTERVAL)
 
     args = p.parse_args()
 
-    # Physical layer needs to know drop and corruption rates.
-    if args.client:
-        physical_layer = PhysicalLayer_Client(args.drop, args.corrupt)
-    else:
-        physical_layer = PhysicalLayer_Server(args.drop, args.corrupt)
+    # Physical layer needs to know how outbound frames should be batched.
+    physical_options = {
+        'flush_bytes': args.flush_bytes,
+        'flush_delay': args.flush_delay,
+        'nodelay': not args.nagle
+    }
 
-    # Data link layer only needs to know about the physical layer.
-    # Different subclasses are implemented for SR and GBN.
-    if args.sr:
-        data_link = DataLinkLayer_SR(physical_layer, args.verbose)
-    else:
-        data_link = DataLinkLayer_GBN(physical_layer, args.verbose)
+    if args.client or args.udp:
+        # A single connection.
+        start_metrics(args)
+
+        if args.udp:
+            physical_class = PhysicalLayer_UDPClient if args.client \
+                else PhysicalLayer_UDPServer
+        else:
+            physical_class = PhysicalLayer_Client
+        physical_layer = physical_class(args.drop, args.corrupt,
+                                        impairment=make_impairment(args),
+                                        **physical_options)
+        data_link = make_datalink(args, physical_layer)
+
+        # Application layer only needs to know about data link layer.
+        # Different sublasses are implemented for client, or server.
+        if args.client:
+            application = ClientApplicationLayer(data_link)
+        else:
+            application = ServerApplicationLayer(data_link)
 
-    # Application layer only needs to know about data link layer.
-    # Different sublasses are implemented for client, or server.
-    if args.client:
-        application = ClientApplicationLayer(data_link)
     else:
-        application = ServerApplicationLayer(data_link)
+        # The TCP server serves any number of clients, each over a physical,
+        # data-link and application layer of its own, on a pool of worker
+        # threads. Further processes share the listening address, so the
+        # work spreads across cores. With the reactor, one thread per
+        # process does every connection's receiving.
+        process_number = 0
+        for n in xrange(1, args.processes):
+            if os.fork() == 0:
+                process_number = n
+                break
+
+        start_metrics(args, process_number)
+
+        listener = Listener(reuse_port=args.processes > 1)
+        pool = SessionPool(serve_session, args.max_sessions)
+
+        # Each client's impairment gets a seed of its own, so runs with a
+        # seed stay reproducible whichever order sessions run in.
+        for client_number in itertools.count():
+            sock, remote_addr = listener.accept()
+            pool.submit(args, sock, remote_addr,
+                        make_impairment(args, client_number), physical_options)
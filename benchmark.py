@@ -0,0 +1,111 @@
+import os
+import sys
+import time
+import signal
+import argparse
+from threading import Thread
+
+from physical import loopback_pair
+from reactor import reactor
+from metrics import registry
+from datalink import DataLinkLayer_SR, DataLinkLayer_GBN
+from utils import *
+
+
+# Register sigint handler.
+signal.signal(signal.SIGINT, sigint_handle)
+
+
+def run(args):
+    """
+    Send `args.transfers` messages from a client data-link layer to a server
+    one in this same process, and return the time each took to arrive and
+    both ends' data-link layers.
+    """
+
+    # Both ends live in this process, over a pair of connected sockets.
+    # With a seed, the same frames are impaired on every run. With the
+    # reactor, one thread does the receiving for both.
+    client_physical, server_physical = loopback_pair(
+        args.drop, args.corrupt, datagrams=args.datagrams, seed=args.seed,
+        reactor=reactor if args.reactor else None)
+
+    datalink_options = {
+        'max_frame_size': args.max_frame_size,
+        'fec_k': args.fec
+    }
+    if args.sr:
+        client = DataLinkLayer_SR(client_physical, False, **datalink_options)
+        server = DataLinkLayer_SR(server_physical, False, **datalink_options)
+    else:
+        client = DataLinkLayer_GBN(client_physical, False, **datalink_options)
+        server = DataLinkLayer_GBN(server_physical, False, **datalink_options)
+
+    # The same message every time, so runs are comparable.
+    message = os.urandom(args.size)
+
+    # Sending blocks until the window takes the whole message, so do it
+    # from another thread while this one times the arrivals.
+    sender = Thread(target=lambda: [client.send(message)
+                                    for _ in xrange(args.transfers)])
+    sender.setDaemon(True)
+    sender.start()
+
+    times = []
+    for _ in xrange(args.transfers):
+        start = time.time()
+        if server.recv(args.size) != message:
+            raise Exception('Message arrived damaged.')
+        times.append(time.time() - start)
+
+    return times, client, server
+
+
+if __name__ == "__main__":
+    # Parse command line args.
+    p = argparse.ArgumentParser()
+    p.add_argument('--transfers', type=int, default=1000)
+    p.add_argument('--size', type=int, default=4096)
+    p.add_argument('--drop', type=int, default=DEFAULT_DROP_RATE)
+    p.add_argument('--corrupt', type=int, default=DEFAULT_CORRUPTION_RATE)
+    p.add_argument('--sr', action='store_true')
+    p.add_argument('--datagrams', action='store_true')
+    p.add_argument('--max-frame-size', type=int,
+                   default=DEFAULT_MAX_FRAME_SIZE)
+    p.add_argument('--fec', type=int, default=0)
+    p.add_argument('--seed', type=int)
+    p.add_argument('--reactor', action='store_true')
+    p.add_argument('--metrics')
+    p.add_argument('--metrics-format', choices=['prometheus', 'json'],
+                   default='prometheus')
+
+    args = p.parse_args()
+
+    start = time.time()
+    times, client, server = run(args)
+    elapsed = time.time() - start
+
+    times.sort()
+    print "%s drop=%d corrupt=%d: %d transfers of %d bytes in %0.2fs" % \
+        ("SR" if args.sr else "GBN", args.drop, args.corrupt,
+         args.transfers, args.size, elapsed)
+    print "Throughput: %0.1f KB/s" % \
+        (args.transfers * args.size / elapsed / 1024)
+    print "Transfer time: median %0.4fs, 99th percentile %0.4fs" % \
+        (times[len(times) // 2], times[len(times) * 99 // 100])
+
+    for name in sorted(client.statistics):
+        print "%s: client %s, server %s" % \
+            (name, client.statistics[name], server.statistics[name])
+
+    if args.metrics:
+        with open(args.metrics, 'w') as f:
+            f.write(registry.export(args.metrics_format))
+
+    # Shut both ends down, then leave without waiting for the daemon
+    # threads, such as the timer scheduler's, which would otherwise die
+    # noisily as the interpreter tears down around them.
+    client.connection_ended()
+    server.connection_ended()
+    sys.stdout.flush()
+    os._exit(0)
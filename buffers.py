@@ -0,0 +1,123 @@
+import threading
+import time
+
+
+class ReceiveBuffer(object):
+    """
+    A growable byte buffer which one thread fills and another drains.
+
+    Bytes live in a single bytearray. Reads advance a start offset instead of
+    re-slicing the whole buffer, and consumed space is reclaimed once it makes
+    up more than half of the buffer, so the cost per byte stays flat no matter
+    how much data flows through. Readers block on a condition variable until
+    enough data has been written, rather than spinning.
+    """
+
+    def __init__(self):
+        # Backing storage. Valid data is self.data[self.start:].
+        self.data = bytearray()
+        self.start = 0
+
+        # Set once the writer will never write again.
+        self.closed = False
+
+        # Signalled whenever data is written or the buffer is closed.
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.data) - self.start
+
+    def write(self, data):
+        """
+        Append data to the end of the buffer, waking any blocked readers.
+        """
+        with self.condition:
+            self.data += data
+            self.condition.notify_all()
+
+    def close(self):
+        """
+        Mark the buffer as finished, waking any blocked readers.
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+    def wait_for(self, n, timeout):
+        """
+        Wait until at least n bytes are buffered or the buffer is closed.
+        Returns False if `timeout` seconds pass first. None waits for as long
+        as it takes. The condition must be held.
+        """
+        if timeout is None:
+            while len(self) < n and not self.closed:
+                self.condition.wait()
+            return True
+
+        deadline = time.time() + timeout
+        while len(self) < n and not self.closed:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return False
+            self.condition.wait(remaining)
+        return True
+
+    def read(self, n, timeout=None):
+        """
+        Remove and return exactly n bytes, blocking until they are available.
+        Returns fewer bytes only if the buffer was closed first, or None,
+        removing nothing, if they don't arrive within `timeout` seconds.
+        """
+        with self.condition:
+            if not self.wait_for(n, timeout):
+                return None
+
+            end = min(self.start + n, len(self.data))
+            to_return = bytes(self.data[self.start:end])
+            self.start = end
+
+            # Reclaim consumed space once it dominates the buffer.
+            if self.start > len(self.data) // 2:
+                del self.data[:self.start]
+                self.start = 0
+
+            return to_return
+
+    def read_into(self, buf, n, timeout=None):
+        """
+        Remove exactly n bytes, copying them straight into the start of the
+        writable buffer `buf`, and blocking until they are available.
+        Returns the number of bytes copied, which is fewer than n only if
+        the buffer was closed first, or None, copying nothing, if they don't
+        arrive within `timeout` seconds.
+        """
+        with self.condition:
+            if not self.wait_for(n, timeout):
+                return None
+
+            n = min(n, len(self))
+            memoryview(buf)[:n] = \
+                memoryview(self.data)[self.start:self.start + n]
+            self.start += n
+
+            # Reclaim consumed space once it dominates the buffer.
+            if self.start > len(self.data) // 2:
+                del self.data[:self.start]
+                self.start = 0
+
+            return n
+
+    def read_available(self, n):
+        """
+        Remove and return everything currently buffered, blocking until at
+        least n bytes are available. Returns fewer bytes only if the buffer
+        was closed first.
+        """
+        with self.condition:
+            self.wait_for(n, None)
+
+            to_return = bytes(self.data[self.start:])
+            del self.data[:]
+            self.start = 0
+
+            return to_return
@@ -0,0 +1,45 @@
+import zlib
+
+
+def legacy_checksum(data):
+    """
+    The checksum frames first used: every byte counted twice, plus every
+    third byte starting from the second. Weaker than the others, but still
+    selectable.
+    """
+    data = bytearray(data)
+
+    # Same as summing data, data[::2], data[1::2] and data[1::3].
+    checksum = 2 * sum(data) + sum(data[1::3])
+
+    # Keep it below four byte unsigned max.
+    return checksum % (2**32)
+
+
+def crc32_checksum(data):
+    """
+    CRC-32 of the data, computed in C. Catches byte swaps and burst errors
+    which the legacy checksum misses.
+    """
+    return zlib.crc32(data) & 0xffffffff
+
+
+def adler32_checksum(data):
+    """
+    Adler-32 of the data, computed in C. Cheaper than CRC-32 but weaker on
+    short frames.
+    """
+    return zlib.adler32(data) & 0xffffffff
+
+
+# Mapping from checksum algorithm name to the function computing it. Each
+# takes a string or buffer and returns a four byte unsigned int.
+CHECKSUMS = {
+    'legacy': legacy_checksum,
+    'crc32': crc32_checksum,
+    'adler32': adler32_checksum
+}
+
+# Checksum names from strongest to weakest. The handshake picks the first
+# one both ends support, and numbers them in this order on the wire.
+CHECKSUM_PREFERENCE = ['crc32', 'adler32', 'legacy']
@@ -2,83 +2,587 @@
 # https://docs.python.org/2/library/struct.html
 import struct
 import time
-from threading import Thread, Timer
-
+from collections import deque
+from Queue import Queue
+from threading import Thread, Condition, Event, Lock, RLock
+
+from checksums import CHECKSUMS
+from framing import make_decoder, encode_frame, encode_sack, decode_sack, \
+    Frame, Packet, DATA_FRAME, SACK_FRAME, HELLO_FRAME, PARITY_FRAME, HELLO, \
+    HELLO_HAVE_PEER, PARITY_HEADER, PARITY_RECORD, FRAME_HEADER, \
+    MAX_FRAME_SIZE, NO_PREV
+from fec import ParityEncoder, ParityDecoder
+from metrics import Metrics, registry
+from rtt import RttEstimator
+from buffers import ReceiveBuffer
+from timers import scheduler
+from windows import SlotWindow
 from utils import *
 
 
 class DataLinkLayer(object):
-    def __init__(self, physical_layer, verbose):
+    def __init__(self, physical_layer, verbose, initial_rto, window_len,
+                 max_window=None, adaptive_window=False,
+                 ack_delay=DEFAULT_ACK_DELAY, checksum=DEFAULT_CHECKSUM,
+                 max_frame_size=DEFAULT_MAX_FRAME_SIZE, fec_k=0,
+                 fec_m=DEFAULT_FEC_PARITY, frame_decoder=None, hello=None):
         self.physical_layer = physical_layer
         self.verbose = verbose
 
-        # Buffer for data that has been processed correctly, but that the
-        # application has not requested.
-        self.received_data_buffer = ""
+        # Number of unacked packets which can remain in the window at once.
+        self.window_len = window_len
+
+        # In adaptive mode the window grows on clean acks and shrinks on
+        # loss, staying between `min_window` and `max_window`. The floor
+        # keeps random loss on a bad link from collapsing it entirely.
+        # `window_size` is the fractional size, which `window_len` rounds
+        # down.
+        self.adaptive_window = adaptive_window
+        self.min_window = window_len
+        self.max_window = max(max_window or window_len, window_len)
+        self.window_size = float(window_len)
+        self.last_shrink = 0.0
+
+        # Name and function of the checksum algorithm used on this
+        # connection. Both ends must use the same one.
+        self.checksum_name = checksum
+        self.checksum_func = CHECKSUMS[checksum]
+
+        # Largest frame, header included, to send or accept. Both ends must
+        # use the same one.
+        if not FRAME_HEADER.size < max_frame_size <= MAX_FRAME_SIZE:
+            raise Exception('Frame size must be between %d and %d.' %
+                            (FRAME_HEADER.size + 1, MAX_FRAME_SIZE))
+        self.max_frame_size = max_frame_size
+        self.max_payload = max_frame_size - FRAME_HEADER.size
+
+        # With forward error correction, every `fec_k` data frames are
+        # followed by `fec_m` parity frames, from which the receiver can
+        # rebuild lost ones without waiting for a retransmission. Data
+        # fragments leave room for the parity header and the stream fields
+        # parity covers, so parity frames fit in a frame too. Zero disables
+        # it.
+        self.parity_encoder = ParityEncoder(fec_k, fec_m) if fec_k else None
+        self.parity_decoder = ParityDecoder()
+        self.fragment_size = self.max_payload
+        if fec_k:
+            self.fragment_size -= PARITY_HEADER.size + PARITY_RECORD.size
+
+        # Buffers, by stream, for data that has been processed correctly,
+        # but that the application has not requested. Streams the other end
+        # opens are announced on `new_streams`.
+        self.stream_buffers = {}
+        self.streams_lock = Lock()
+        self.new_streams = Queue()
+
+        # Sequence number of the last frame sent, and of the last one
+        # delivered, on each stream.
+        self.stream_last_sent = {}
+        self.stream_delivered = {}
+
+        # Fragments waiting to be sent, by stream, and the streams which
+        # have some in the order they take turns. Each fragment comes with
+        # an event to set once it is sent, if it ends a message.
+        self.send_queues = {}
+        self.ready_streams = deque()
+        self.send_queue_condition = Condition()
+
+        # Set once the other end has gone away.
+        self.closed = False
+
+        # Several threads share the connection's state: the sender, the
+        # receive thread or reactor, and the timer thread. Each event takes
+        # the one lock for the state it changes, for just as long as it
+        # handles the event, so sending and receiving don't hold each other
+        # up. Where both are needed, the receive lock is taken first.
+        #
+        # The receive lock covers what has been received: the receive
+        # window and the frame decoder.
+        self.receive_lock = RLock()
+
+        # The window lock covers sending: the send window, sequence
+        # numbers, retransmission timers, and the RTT and window size
+        # estimates. Its condition is signalled whenever the send window may
+        # have room for another packet.
+        self.window_lock = RLock()
+        self.window_condition = Condition(self.window_lock)
+
+        # Covers the owed ack. Nothing else is taken while holding it, or
+        # the metrics' own lock.
+        self.ack_lock = Lock()
 
         # Buffer for data that the application has sent, but that has not been
         # acked yet. This must not be longer than `self.window_len`
-        self.send_window = []
+        self.send_window = deque()
 
         self.send_window_base = 0
 
         # Next packet to send.
         self.next_seq = 0
 
-        self.statistics = {
-            'frames_transmitted': 0,
-            'retransmissions': 0,
-            'acks_sent': 0,
-            'acks_received': 0,
-            'duplicates_received': 0,
-            'time_to_recognize': 0.0
-        }
+        # Splits the physical layer's byte stream into frames. After a
+        # handshake, carry on with its decoder, which may already hold the
+        # start of the first frames, switched over to the agreed format.
+        if frame_decoder is None:
+            frame_decoder = make_decoder(physical_layer, self.checksum,
+                                         self.max_payload)
+        else:
+            frame_decoder.checksum = self.checksum
+            frame_decoder.max_payload = self.max_payload
+        self.frame_decoder = frame_decoder
+
+        # Our handshake frame, resent to the other end for as long as it
+        # says it is missing our offer. None without a handshake.
+        self.hello = hello
+
+        # Armed retransmission timers, by sequence number.
+        self.timers = {}
+
+        # Round trip time estimate, which sets the retransmission timeout.
+        self.rtt = RttEstimator(initial_rto, ack_delay)
+
+        # Seconds an ack may be held back, hoping to ride along on an
+        # outbound data frame or to cover more arrivals. Zero disables it.
+        self.ack_delay = ack_delay
+
+        # Set while an ack is owed but has not been sent yet.
+        self.ack_pending = False
+        self.ack_timer = None
+
+        # Counters, gauges and histograms for this connection, exported
+        # alongside the physical layer's under the same connection label.
+        # The counters and gauges are also its statistics.
+        labels = {'connection': registry.next_connection_id()}
+        self.metrics = Metrics('datalink', labels)
+        for name in ('frames_transmitted', 'retransmissions', 'acks_sent',
+                     'acks_received', 'duplicates_received',
+                     'acks_piggybacked', 'parity_frames_sent',
+                     'fec_recovered', 'frames_received',
+                     'frame_bytes_sent', 'frame_bytes_received',
+                     'app_bytes_sent', 'app_bytes_delivered', 'bytes_acked'):
+            self.metrics.counter(name)
+        self.metrics.gauge('time_to_recognize')
+        self.metrics.gauge('srtt')
+        self.metrics.gauge('rto', initial_rto)
+        self.metrics.gauge('window_len', window_len)
+        self.metrics.gauge_func('window_in_flight',
+                                lambda: len(self.send_window))
+
+        # Goodput: message bytes per second which got to the application at
+        # this end, and which the other end acked.
+        self.metrics.gauge_func('receive_goodput_bytes_per_second',
+                                lambda: self.goodput('app_bytes_delivered'))
+        self.metrics.gauge_func('send_goodput_bytes_per_second',
+                                lambda: self.goodput('bytes_acked'))
+
+        # Round trip times, by Karn's rule; time from first sending each
+        # packet to its ack, retransmissions included; time from first
+        # sending a packet to each resend of it; and packets in flight as
+        # each new one is sent.
+        self.metrics.histogram('rtt_seconds', HISTOGRAM_TIME_UNIT)
+        self.metrics.histogram('ack_seconds', HISTOGRAM_TIME_UNIT)
+        self.metrics.histogram('retransmit_delay_seconds',
+                               HISTOGRAM_TIME_UNIT)
+        self.metrics.histogram('window_occupancy', 1)
+
+        self.statistics = self.metrics.values
+
+        physical_layer.metrics.labels = labels
+        registry.add(self.metrics)
+        registry.add(physical_layer.metrics)
 
     def start_receive_thread(self):
         self.receive_thread = Thread(target=self.receive_thread_func)
         self.receive_thread.setDaemon(True)
         self.receive_thread.start()
 
+    def start_send_thread(self):
+        self.send_thread = Thread(target=self.send_thread_func)
+        self.send_thread.setDaemon(True)
+        self.send_thread.start()
+
+    def start_threads(self):
+        # An evented physical layer calls us back as data arrives, so only
+        # sending needs a thread.
+        if self.physical_layer.evented:
+            self.physical_layer.attach(self)
+        else:
+            self.start_receive_thread()
+        self.start_send_thread()
+
+    def send_thread_func(self):
+        """
+        Send queued fragments one frame at a time, taking turns between the
+        streams which have any, so a bulk transfer can't hold up the rest.
+        """
+        while True:
+            with self.send_queue_condition:
+                while not self.ready_streams:
+                    # Nothing more will be sent once the connection has
+                    # ended.
+                    if self.closed:
+                        return
+                    self.send_queue_condition.wait()
+
+                stream = self.ready_streams.popleft()
+                queue = self.send_queues[stream]
+                fragment, sent = queue.popleft()
+
+                # Back of the line, if it has more to send.
+                if queue:
+                    self.ready_streams.append(stream)
+
+            self.send_frame(fragment, stream)
+
+            if sent is not None:
+                sent.set()
+
     def receive_thread_func(self):
         while True:
-            self.recv_one_frame()
-            time.sleep(0.005)
+            frames = self.frame_decoder.decode()
+
+            # Nothing more will arrive once the connection has ended.
+            if not frames:
+                self.connection_ended()
+                return
 
-    def recv(self, n):
+            with self.receive_lock:
+                for frame in frames:
+                    self.handle_frame(frame)
+                self.frames_handled()
+
+    def data_received(self):
+        """
+        Handle every complete frame the physical layer has buffered, in
+        place of the receive thread. Called by an evented physical layer as
+        data arrives, and once more when the connection ends.
+        """
+        with self.receive_lock:
+            while True:
+                frame = self.frame_decoder.decode_one(block=False)
+                if frame is None:
+                    break
+                self.handle_frame(frame)
+            self.frames_handled()
+
+        # Nothing more will arrive once the connection has ended.
+        if self.physical_layer.received_data_buffer.closed:
+            self.connection_ended()
+
+    def connection_ended(self):
         """
-        Receive n correctly-ordered bytes from the data-link layer.
+        The other end has gone away. Stop retransmitting, let everything
+        waiting to receive see the end of its stream, and release everything
+        waiting to send.
         """
+        with self.streams_lock:
+            if self.closed:
+                return
+            self.closed = True
+            for buf in self.stream_buffers.values():
+                buf.close()
+        self.new_streams.put(None)
+
+        with self.window_lock:
+            for seqnum in list(self.timers):
+                self.stop_timer_for(seqnum)
+        self.clear_pending_ack()
+
+        with self.send_queue_condition:
+            for queue in self.send_queues.values():
+                for _, sent in queue:
+                    if sent is not None:
+                        sent.set()
+                queue.clear()
+            self.ready_streams.clear()
+            self.send_queue_condition.notify_all()
+        self.window_opened()
+
+        self.physical_layer.close()
+
+        registry.remove(self.metrics)
+        registry.remove(self.physical_layer.metrics)
+
+    def handle_frame(self, frame):
+        """
+        Pass one decoded frame to whatever deals with its kind.
+        """
+        self.count('frames_received')
+        self.count('frame_bytes_received',
+                   FRAME_HEADER.size + len(frame.payload))
+
+        if frame.valid and frame.kind == HELLO_FRAME:
+            self.received_hello(frame.payload)
 
-        # Block the application from receiving until we have enough data.
-        while len(self.received_data_buffer) < n:
-            pass
+        elif frame.valid and frame.kind == PARITY_FRAME:
+            self.recover_frames(self.parity_decoder.add_parity(
+                frame.seq, frame.ack, frame.payload))
 
-        # Remove `n` bytes from beginning of received data buffer.
-        to_return, self.received_data_buffer = \
-            self.received_data_buffer[:n], self.received_data_buffer[n:]
+        else:
+            self.recv_one_frame(frame)
+
+            # Keep data frames around for rebuilding lost ones, once the
+            # other end has shown it sends parity.
+            if self.parity_decoder.k and frame.valid and \
+                    frame.kind == DATA_FRAME and frame.payload:
+                record = PARITY_RECORD.pack(frame.stream, frame.prev) + \
+                    frame.payload
+                self.recover_frames(self.parity_decoder.add_data(frame.seq,
+                                                                 record))
 
-        return to_return
+        self.parity_decoder.discard_before(self.next_expected())
 
-    @staticmethod
-    def checksum(data, pack=True):
+    def recovered_frame(self, seq, record):
         """
-        Returns a one-byte checksum of the data.
+        Returns the data frame with sequence number `seq` from the record
+        the parity decoder keeps for it.
         """
-        checksum = 0
-        for character in data:
-            checksum += ord(character)
+        stream, prev = PARITY_RECORD.unpack_from(record)
+        return Frame(True, DATA_FRAME, stream, seq, 0, prev,
+                     record[PARITY_RECORD.size:])
 
-        for character in data[::2]:
-            checksum += ord(character)
+    def recover_frames(self, recovered):
+        """
+        Handle data frames rebuilt from parity as if they had arrived.
+        """
+        for seq, record in recovered:
+            self.count('fec_recovered')
+            self.recv_one_frame(self.recovered_frame(seq, record))
+
+    def send_parity(self, packet):
+        """
+        Account for a data frame's first transmission, sending the parity
+        frames for its group once it is complete.
+        """
+        if self.parity_encoder is None:
+            return
+
+        record = PARITY_RECORD.pack(packet.stream, packet.prev) + \
+            packet.data.tobytes()
+        for base, index, payload in self.parity_encoder.add(packet.seq,
+                                                            record):
+            frame = encode_frame(base, index, payload, self.checksum,
+                                 PARITY_FRAME)
+            self.count('frame_bytes_sent', len(frame))
+            self.physical_layer.send(frame)
+            self.count('parity_frames_sent')
+
+    def received_hello(self, payload):
+        """
+        The other end is still in its handshake. Answer it if it has not
+        got our offer yet.
+        """
+        if self.hello is None or len(payload) != HELLO.size:
+            return
+
+        flags = HELLO.unpack(payload)[1]
+        if not flags & HELLO_HAVE_PEER:
+            self.physical_layer.send(self.hello)
+
+    def frames_handled(self):
+        """
+        Called after each batch of frames the receive thread decodes.
+        """
+
+        # Without a delay, ack the whole batch at once.
+        if self.ack_pending and not self.ack_delay:
+            self.send_pending_ack()
+
+    def schedule_ack(self):
+        """
+        Note that an ack is owed. If an ack delay is set, it waits that long
+        for a data frame to carry it before a bare ack goes out.
+        """
+        with self.ack_lock:
+            if self.ack_pending:
+                return
+            self.ack_pending = True
+
+            if self.ack_delay:
+                self.ack_timer = scheduler.schedule(self.ack_delay,
+                                                    self.ack_delay_expired)
 
-        for character in data[1::2]:
-            checksum += ord(character)
+    def ack_delay_expired(self):
+        """
+        Nothing has carried the owed ack in time, so send it on its own.
+        """
+        with self.receive_lock:
+            self.send_pending_ack()
+
+    def clear_pending_ack(self):
+        """
+        Forget the owed ack, because it has been sent one way or another.
+        Returns whether one was owed.
+        """
+        with self.ack_lock:
+            owed = self.ack_pending
+            self.ack_pending = False
 
-        for character in data[1::3]:
-            checksum += ord(character)
+            if self.ack_timer is not None:
+                scheduler.cancel(self.ack_timer)
+                self.ack_timer = None
 
-        # Keep it below four byte unsigned max.
-        checksum = checksum % (2**32)
+        return owed
+
+    def restore_pending_ack(self):
+        """
+        Owe again an ack claimed for a frame which couldn't carry it after
+        all. It goes out from the timer thread, since the sender may not
+        take the receive lock.
+        """
+        with self.ack_lock:
+            if self.ack_pending:
+                return
+            self.ack_pending = True
+            self.ack_timer = scheduler.schedule(self.ack_delay,
+                                                self.ack_delay_expired)
+
+    def count(self, name, n=1):
+        """
+        Add n to one of the statistics.
+        """
+        self.metrics.count(name, n)
+
+    def goodput(self, name):
+        """
+        Returns a count of bytes as a rate over the connection's lifetime.
+        """
+        return self.statistics[name] / self.metrics.uptime()
+
+    def acked(self, packet):
+        """
+        Record the metrics for a packet the other end has just acked.
+        """
+        self.metrics.observe('ack_seconds', time.time() - packet.sent_at)
+        self.count('bytes_acked', len(packet.data))
+
+    def retransmitting(self, packet):
+        """
+        Record the metrics for a packet about to be sent again.
+        """
+        packet.retransmitted = True
+        self.metrics.observe('retransmit_delay_seconds',
+                             time.time() - packet.sent_at)
+        self.count('retransmissions')
+
+    def stream_buffer(self, stream):
+        """
+        Returns the receive buffer for a stream, creating it the first time
+        the stream is used.
+        """
+        with self.streams_lock:
+            buf = self.stream_buffers.get(stream)
+            if buf is None:
+                buf = self.stream_buffers[stream] = ReceiveBuffer()
+                if self.closed:
+                    buf.close()
+                else:
+                    self.new_streams.put(stream)
+            return buf
+
+    def deliver(self, frame):
+        """
+        Hand a data frame's payload up to its stream, in order.
+        """
+        self.stream_buffer(frame.stream).write(frame.payload)
+        self.stream_delivered[frame.stream] = frame.seq
+        self.count('app_bytes_delivered', len(frame.payload))
+
+    def accept_stream(self):
+        """
+        Block until a stream is used for the first time, and return it.
+        Returns None once the connection has ended.
+        """
+        return self.new_streams.get()
+
+    def recv(self, n, stream=0, timeout=None):
+        """
+        Receive n correctly-ordered bytes from a stream of the data-link
+        layer. Returns None, receiving nothing, if they haven't all arrived
+        within `timeout` seconds. A timeout of zero never blocks.
+        """
+
+        # Blocks until enough data is available.
+        return self.stream_buffer(stream).read(n, timeout)
+
+    def recv_into(self, buf, n=None, stream=0, timeout=None):
+        """
+        Receive n correctly-ordered bytes from a stream straight into the
+        writable buffer `buf`, or enough to fill it if n is not given.
+        Returns the number of bytes received, or None if they haven't all
+        arrived within `timeout` seconds.
+        """
+        if n is None:
+            n = len(buf)
+
+        # Blocks until enough data is available.
+        return self.stream_buffer(stream).read_into(buf, n, timeout)
+
+    def send(self, data, stream=0, timeout=None):
+        """
+        Send a message of any size on a stream of the data-link layer, split
+        across as many frames as it takes. Blocks until every frame has been
+        sent, taking turns with messages on other streams.
+
+        Returns True once they have all been sent, or False if `timeout`
+        seconds pass first. The rest of the message stays queued and goes
+        out in turn, so a timeout of zero queues the message without
+        blocking, and several can be in the pipeline at once.
+        """
+
+        # A frame has one byte for its stream. Catch a bad one here, rather
+        # than in the send thread, which it would take down.
+        if not 0 <= stream <= MAX_STREAM:
+            raise Exception('Stream must be between 0 and %d.' % MAX_STREAM)
+
+        # Frames hold on to their payload until acked, so take a private
+        # copy of anything the caller could change in the meantime.
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        elif isinstance(data, bytearray):
+            data = bytes(data)
+
+        # Each fragment is a view into the message, not a copy of it.
+        view = memoryview(data)
+        fragments = [view[start:start + self.fragment_size]
+                     for start in xrange(0, len(view), self.fragment_size)]
+        if not fragments:
+            return True
+
+        self.count('app_bytes_sent', len(data))
+
+        sent = Event()
+        with self.send_queue_condition:
+            # Nobody is left to send to.
+            if self.closed:
+                return False
+
+            queue = self.send_queues.setdefault(stream, deque())
+            if not queue:
+                self.ready_streams.append(stream)
+                self.send_queue_condition.notify()
+
+            for fragment in fragments[:-1]:
+                queue.append((fragment, None))
+            queue.append((fragments[-1], sent))
+
+        return sent.wait(timeout) and not self.closed
+
+    def prev_on_stream(self, stream, seq):
+        """
+        Returns the sequence number of the last frame sent on a stream, and
+        records `seq` as the new last one.
+        """
+        prev = self.stream_last_sent.get(stream, NO_PREV)
+        self.stream_last_sent[stream] = seq
+        return prev
+
+    def checksum(self, data, pack=True):
+        """
+        Returns a four-byte checksum of the data, using this connection's
+        checksum algorithm.
+        """
+        checksum = self.checksum_func(data)
 
         if pack:
             return struct.pack("!I", checksum)
@@ -86,393 +590,617 @@ class DataLinkLayer(object):
             return checksum
 
 
-    def build_packet(self, payload, seq):
-        seq_num = struct.pack("!I", seq)
-        ack_num = struct.pack("!I", self.ack)
-        payload_len = struct.pack("!B", len(payload))
+    def start_timer_for(self, seqnum, timeout=None):
+        """
+        Arm the retransmission timer for `seqnum`, replacing any timer
+        already running for it. Defaults to the current adaptive timeout.
+        """
+        if timeout is None:
+            timeout = self.rtt.rto
+
+        self.stop_timer_for(seqnum)
+        self.timers[seqnum] = scheduler.schedule(timeout,
+                                                 self.resend_on_timeout,
+                                                 seqnum)
+
+    def stop_timer_for(self, seqnum):
+        """
+        Cancel the retransmission timer for `seqnum`, if there is one.
+        """
+        handle = self.timers.pop(seqnum, None)
+        if handle is not None:
+            scheduler.cancel(handle)
+
+    def wait_for_window(self):
+        """
+        Block until the send window can take one more packet. Returns False
+        if the connection ends first.
+        """
+        with self.window_condition:
+            while len(self.send_window) + 1 > self.window_len and \
+                    not self.closed:
+                self.window_condition.wait()
+
+        return not self.closed
 
-        # The data to prepend a checksum to.
-        to_check = seq_num + ack_num + payload_len + payload
+    def window_opened(self):
+        """
+        Wake the sender, since the send window may have room now.
+        """
+        with self.window_condition:
+            self.window_condition.notify_all()
 
-        # Compute checksum.
-        checksum = self.checksum(to_check)
+    def grow_window(self):
+        """
+        Additive increase: after a window's worth of clean acks, the window
+        has grown by one packet.
+        """
+        if not self.adaptive_window:
+            return
 
-        # Return full packet.
-        return checksum + to_check
+        self.window_size = min(self.window_size + 1.0 / self.window_size,
+                               self.max_window)
+        if int(self.window_size) > self.window_len:
+            self.window_len = int(self.window_size)
+            self.metrics.set('window_len', self.window_len)
+            self.window_opened()
+
+    def shrink_window(self):
+        """
+        Multiplicative decrease: halve the window after a timeout or a
+        corrupt frame.
+        """
+        if not self.adaptive_window:
+            return
+
+        # Losses within one timeout of each other are most likely the same
+        # congestion event, so only back off once for them.
+        now = time.time()
+        if now - self.last_shrink < self.rtt.rto:
+            return
+        self.last_shrink = now
+
+        self.window_size = max(self.window_size / 2, self.min_window)
+        self.window_len = int(self.window_size)
+        self.metrics.set('window_len', self.window_len)
+
+    def sample_rtt(self, packet):
+        """
+        Update the RTT estimate from a packet which was just acked.
+        """
+
+        # Karn's rule: an ack for a retransmitted packet could belong to any
+        # of its copies, so it says nothing about the round trip time.
+        if packet.retransmitted:
+            return
+
+        sample = time.time() - packet.sent_at
+        self.rtt.sample(sample)
+        self.metrics.observe('rtt_seconds', sample)
+        self.metrics.set('srtt', self.rtt.srtt)
+        self.metrics.set('rto', self.rtt.rto)
 
 
 class DataLinkLayer_GBN(DataLinkLayer):
-    def __init__(self, physical_layer, verbose):
-        super(DataLinkLayer_GBN, self).__init__(physical_layer, verbose)
+    def __init__(self, physical_layer, verbose, window_len=GBN_WINDOW_LEN,
+                 dup_ack_threshold=DUP_ACK_THRESHOLD, **kwargs):
+        super(DataLinkLayer_GBN, self).__init__(physical_layer, verbose,
+                                                GBN_INITIAL_RTO, window_len,
+                                                **kwargs)
 
         # Expected sequence number
         self.ack = 0
 
-        # Start the dedicated receiver thread.
-        self.start_receive_thread()
+        # Bare acks in a row which acknowledged nothing new, and how many of
+        # them trigger a fast retransmit. Zero disables fast retransmit.
+        self.dup_acks = 0
+        self.dup_ack_threshold = dup_ack_threshold
 
-        # Number of unacked packets which can remain in the window at once.
-        self.window_len = 5
+        # Set once the window has been fast retransmitted, until the base
+        # moves, so the duplicates still in flight don't trigger it again.
+        self.fast_retransmitted = False
+
+        self.metrics.counter('fast_retransmissions')
 
         self.is_sr = False
 
-    def send_blank_ack(self):
-        # Create a packet containing the ack number
-        new_packet = {'seq': self.next_seq, 'data': ''}
+        # Start the dedicated receiver and sender threads.
+        self.start_threads()
 
-        #Send the ack packet
-        self.send_packet(new_packet)
-        self.statistics['acks_sent'] += 1
-
-    def recv_one_frame(self):
+    def next_expected(self):
+        return self.ack
 
-        # Expected checksum will be first 2 bytes of a new frame.
-        checksum_packed = self.physical_layer.recv(4)
-        checksum_unpacked = struct.unpack("!I", checksum_packed)[0]
+    def recover_frames(self, recovered):
+        super(DataLinkLayer_GBN, self).recover_frames(recovered)
 
-        # Sequence number is next 4 bytes.
-        seq_num_packed = self.physical_layer.recv(4)
-        seq_num_unpacked = struct.unpack("!I", seq_num_packed)[0]
+        # Frames after a lost one were dropped for arriving out of order,
+        # but the parity decoder kept them, so deliver those now in line.
+        while recovered and self.ack in self.parity_decoder.received:
+            self.recv_one_frame(self.recovered_frame(
+                self.ack, self.parity_decoder.received[self.ack]))
 
-        # Acknowledgement number is next 4 bytes.
-        ack_num_packed = self.physical_layer.recv(4)
-        ack_num_unpacked = struct.unpack("!I", ack_num_packed)[0]
+    def send_pending_ack(self):
+        if self.ack_pending:
+            self.send_blank_ack()
 
-        # Payload len is next byte.
-        payload_len_packed = self.physical_layer.recv(1)
-        payload_len_unpacked = struct.unpack("!B", payload_len_packed)[0]
+    def send_blank_ack(self):
+        self.clear_pending_ack()
 
-        # Receive enough for remaining data.
-        if payload_len_unpacked > 0:
-            payload = self.physical_layer.recv(payload_len_unpacked)
-        else:
-            payload = ''
+        # Create a packet containing the ack number
+        new_packet = Packet(self.next_seq, '')
 
-        # This is the data which should match the checksum.
-        to_check = seq_num_packed + ack_num_packed + payload_len_packed + \
-                   payload
+        #Send the ack packet
+        self.send_packet(new_packet)
+        self.count('acks_sent')
 
-        # Compute checksum of data received.
-        observed_checksum = self.checksum(to_check, pack=False)
+    def recv_one_frame(self, frame):
+        payload = frame.payload
 
-        # Compare checksums.
-        if checksum_unpacked == observed_checksum:
+        # Checksum was verified by the frame decoder.
+        if frame.valid:
             if self.verbose:
-                print "Recv - SEQ:%d  ACK:%d  Size:%d" % (seq_num_unpacked,  ack_num_unpacked, payload_len_unpacked)
+                print "Recv - SEQ:%d  ACK:%d  Size:%d" % (frame.seq,  frame.ack, len(payload))
 
-            if payload_len_unpacked == 0:
-                self.statistics['acks_received'] += 1
+            if len(payload) == 0:
+                self.count('acks_received')
 
-            self.received_ack(ack_num_unpacked)
+            self.received_ack(frame.ack, bare=len(payload) == 0)
 
             # This is an expected data chunk
-            if seq_num_unpacked == self.ack and len(payload) > 0:
-                self.received_data_buffer += payload
-                self.ack = seq_num_unpacked + 1
-            elif seq_num_unpacked < self.ack:
-                self.statistics['duplicates_received'] += 1
+            if frame.seq == self.ack and len(payload) > 0:
+                self.deliver(frame)
+                self.ack = frame.seq + 1
+
+                # The ack for it may wait for data going back.
+                if self.ack_delay:
+                    self.schedule_ack()
+                    return
 
-        elif self.verbose:
-            print "Recv - Bad checksum"
+            elif frame.seq < self.ack:
+                self.count('duplicates_received')
+
+        else:
+            # Corruption means the link is struggling, so send less at once.
+            self.shrink_window()
+            if self.verbose:
+                print "Recv - Bad checksum"
 
-        if payload_len_unpacked != 0:
+        # Anything unexpected is acked right away, so the sender can count
+        # duplicate acks.
+        if len(payload) != 0:
             self.send_blank_ack()
 
 
-    def received_ack(self, ack_num):
+    def received_ack(self, ack_num, bare=False):
         """
         The next packet they expect is `ack_num`. Remove anything else from
-        send window.
+        send window. `bare` is set if the ack came without data.
+        """
+
+        with self.window_lock:
+            # Do nothing if the send window is empty
+            if len(self.send_window) == 0:
+                return
+
+            oldest_seq = self.send_window[0].seq
+            newest_acked = None
+
+            while True:
+                if self.send_window and self.send_window[0].seq < ack_num:
+                    newest_acked = self.send_window[0]
+                    self.acked(newest_acked)
+                    self.send_window.popleft()
+                    self.grow_window()
+                else:
+                    break
+
+            # The newest packet covered by this ack gives the freshest
+            # sample, and the window has room for more.
+            if newest_acked is not None:
+                self.sample_rtt(newest_acked)
+                self.window_opened()
+
+            # If the oldest packet got acked, its timer is done. Time the new
+            # oldest packet instead, if there is one, without the backoff:
+            # the link is delivering again.
+            if not self.send_window or self.send_window[0].seq != oldest_seq:
+                self.rtt.reset_backoff()
+                self.metrics.set('rto', self.rtt.rto)
+                self.stop_timer_for(oldest_seq)
+                if self.send_window:
+                    self.start_timer_for(self.send_window[0].seq)
+
+                # New data was acked, so start counting duplicates afresh.
+                self.dup_acks = 0
+                self.fast_retransmitted = False
+
+            # They are still waiting for our oldest packet.
+            elif bare and ack_num == oldest_seq:
+                self.received_dup_ack()
+
+    def received_dup_ack(self):
         """
+        Count an ack which acknowledged nothing new. Enough of them in a row
+        mean the oldest packet was lost while later ones got through, so
+        resend the window without waiting for the timer.
+        """
+        self.dup_acks += 1
 
-        # Do nothing if the send window is empty
-        if len(self.send_window) == 0:
+        if not self.dup_ack_threshold or self.fast_retransmitted or \
+                self.dup_acks < self.dup_ack_threshold:
             return
 
-        while True:
-            if self.send_window and self.send_window[0]['seq'] < ack_num:
+        self.fast_retransmitted = True
+        self.count('fast_retransmissions')
+        self.resend_window()
 
-                if DEBUG:
-                    if "starwars" in self.send_window[0]['data']:
-                        log_func(self)
-                        print "Done"
+        # Give the resent window a full timeout before trying again.
+        self.start_timer_for(self.send_window[0].seq)
 
-                self.send_window = self.send_window[1:]
-            else:
-                break
+    def resend_window(self):
+        """
+        Go back N: resend everything still unacked.
+        """
+        for packet in self.send_window:
+            self.retransmitting(packet)
+            self.send_packet(packet)
 
     def resend_on_timeout(self, seqnum):
-        if len(self.send_window) == 0:
-            return
+        with self.window_lock:
+            # Ignore a timer for a packet which has since been acked.
+            if len(self.send_window) == 0 or self.send_window[0].seq != seqnum:
+                return
 
-        if self.ack <= seqnum:
-            for packet in self.send_window:
-                if packet['seq'] <= seqnum:
-                    self.send_packet(packet)
-                    self.statistics['retransmissions'] += 1
-            if len(self.send_window) != 0:
-                self.start_timer_for(self.send_window[0]['seq'])
-        else:
-            self.start_timer_for(self.next_seq - 1)
+            self.resend_window()
 
+            # Back off, in case the timeout was too short for this link, and
+            # send less at once.
+            self.shrink_window()
+            self.rtt.backoff()
+            self.metrics.set('rto', self.rtt.rto)
+            self.start_timer_for(seqnum)
 
-    def send(self, data):
+
+    def send_frame(self, data, stream=0):
         """
-        Send data through the data-link layer.
+        Send one frame's worth of data on a stream through the data-link
+        layer.
         """
 
-        if len(data) > 256:
-            raise Exception('Chunk from application too large.')
-
-        # Block until the window can take one more packet.
-        while len(self.send_window) + 1 > self.window_len:
-            time.sleep(0.5)
+        with self.window_lock:
+            # Block until the window can take one more packet.
+            if not self.wait_for_window():
+                return
 
-        # New item to add to the window.
-        new_packet = {'seq': self.next_seq, 'data': data}
+            # New item to add to the window.
+            prev = self.prev_on_stream(stream, self.next_seq)
+            new_packet = Packet(self.next_seq, data, stream=stream,
+                                prev=prev, sent_at=time.time())
 
-        # Put the given data at the end of the window.
-        self.send_window.append(new_packet)
+            # Put the given data at the end of the window.
+            self.send_window.append(new_packet)
+            self.metrics.observe('window_occupancy', len(self.send_window))
 
-        # Send it along the physical layer.
-        self.send_packet(new_packet)
+            # Send it along the physical layer.
+            self.send_packet(new_packet)
+            self.send_parity(new_packet)
 
-        # Start timer for packet if it is the only thing in the send window.
-        if len(self.send_window) == 1:
-            self.start_timer_for(self.next_seq)
+            # Start timer for packet if it is the only thing in the send
+            # window.
+            if len(self.send_window) == 1:
+                self.start_timer_for(self.next_seq)
 
-        # Increment the sequence
-        self.next_seq += 1
+            # Increment the sequence
+            self.next_seq += 1
 
     def send_packet(self, pk):
-        self.statistics['frames_transmitted'] += 1
-        packet = self.build_packet(pk['data'], pk['seq'])
+        self.count('frames_transmitted')
+
+        # Every data frame carries our ack number, so any owed ack rides
+        # along with it. Claim the ack before reading the number, so an ack
+        # owed for a newer one is left for the receive thread to send.
+        if pk.data and self.clear_pending_ack():
+            self.count('acks_piggybacked')
+
+        ack = self.ack
+        packet = pk.encode(ack, self.checksum)
 
         if self.verbose:
-            print "Send - SEQ:%d  ACK:%d  Size:%d" % (pk['seq'], self.ack,
-                                                      len(pk['data']))
+            print "Send - SEQ:%d  ACK:%d  Size:%d" % (pk.seq, ack,
+                                                      len(pk.data))
 
+        self.count('frame_bytes_sent', len(packet))
         self.physical_layer.send(packet)
 
-    def start_timer_for(self, seqnum):
-        t = Timer(0.3, self.resend_on_timeout, [seqnum])
-        t.start()
 
 class DataLinkLayer_SR(DataLinkLayer):
-    def __init__(self, physical_layer, verbose):
-        super(DataLinkLayer_SR, self).__init__(physical_layer, verbose)
-
-        # Create a receive window
-        self.recv_window = []
+    def __init__(self, physical_layer, verbose, window_len=SR_WINDOW_LEN,
+                 sack=True, **kwargs):
+        super(DataLinkLayer_SR, self).__init__(physical_layer, verbose,
+                                               SR_INITIAL_RTO, window_len,
+                                               **kwargs)
 
-        # Create a receive window base
-        self.recv_window_base = 0
-
-        self.start_receive_thread()
-
-        # Number of unacked packets which can remain in the window at once.
-        self.window_len = 30
         self.is_sr = True
 
-    def build_packet(self, payload, seq, ack):
-        seq_num = struct.pack("!I", seq)
-        ack_num = struct.pack("!I", ack)
-        payload_len = struct.pack("!B", len(payload))
+        # Whether to ack with one selective ack covering everything
+        # received, instead of one ack frame per data frame.
+        self.sack = sack
 
-        # The data to prepend a checksum to.
-        to_check = seq_num + ack_num + payload_len + payload
+        # Sent but unacked packets, and received packets waiting for the
+        # ones before them, both indexed by sequence number. Both are sized
+        # for the largest the window can grow to.
+        self.send_window = SlotWindow(self.max_window)
+        self.recv_window = SlotWindow(self.max_window)
 
-        # Compute checksum.
-        checksum = self.checksum(to_check)
+        # Received frames held up by an earlier frame on their stream,
+        # keyed by the sequence number of that earlier frame.
+        self.stream_waiting = {}
 
-        # Return full packet.
-        return checksum + to_check
+        # Sequence numbers of sent packets whose timers are backed off, so
+        # only they need re-arming once the link delivers again.
+        self.backed_off = set()
+
+        self.start_threads()
 
     def send_blank_ack(self, recv_seq_num):
+        # With selective acks, just note that an ack is owed.
+        if self.sack:
+            self.schedule_ack()
+            return
+
         # Create a packet containing the ack number
-        new_packet = {'seq': self.next_seq, 'ack': recv_seq_num, 'data': ''}
+        new_packet = Packet(self.next_seq, '', ack=recv_seq_num)
 
         #Send the ack packet
         self.send_packet(new_packet)
-        self.statistics['acks_sent'] += 1
-
-    def update_recv_window(self, recv_packet):
-        """
-        Update the receive window
-        """
-        # If the new packet has the sequence number of the receive window base
-        if recv_packet['seq'] == self.recv_window_base:
-
-            # Send up the packet and increase the base
-            self.received_data_buffer += recv_packet['data']
-            self.recv_window_base += 1
-            trackseq = self.recv_window_base
-
-            # For each consecutive packet with a sequence number matching the base
-            # Send it up and increase the base once more
-            while len(self.recv_window) > 0 and self.recv_window[0]['seq'] == trackseq:
-                self.received_data_buffer += self.recv_window[0]['data']
-                self.recv_window.pop(0)
-                self.recv_window_base += 1
-                trackseq += 1
-            self.send_blank_ack(recv_packet['seq'])
-
-        # Otherwise insert the recv packet into the correct place in the list
-        elif not recv_packet['seq'] >= self.recv_window_base + self.window_len:
-
-            # If receive window is empty append the packet
-            if len(self.recv_window) == 0:
-                self.recv_window.append(recv_packet)
-            else:
-                insertindex = 0
-                found = False
-
-                # Find the largest prequel to the packet sequence number
-                for packet in self.recv_window:
-                    if recv_packet['seq'] > packet['seq']:
-                        insertindex += 1
-                    elif recv_packet['seq'] == [packet['seq']]:
-                        found = True
-                    else:
-                        return
-                if not found:
-                    # If the packet is not already in the list insert it
-                    self.recv_window.insert(insertindex, recv_packet)
-                else:
-                    self.statistics['duplicates_received'] += 1
-            self.send_blank_ack(recv_packet['seq'])
+        self.count('acks_sent')
+
+    def next_expected(self):
+        return self.recv_window.base
+
+    def send_pending_ack(self):
+        """
+        Send one selective ack covering everything received so far.
+        """
+        if not self.clear_pending_ack():
+            return
+
+        # Everything before the receive base has been delivered, and the
+        # buffered frames beyond it are marked in the bitmap.
+        cumulative_ack = self.recv_window.base
+        received = [seq for seq in xrange(cumulative_ack + 1,
+                                          self.recv_window.end)
+                    if seq in self.recv_window]
+        bitmap = encode_sack(cumulative_ack, received, self.max_payload)
+
+        new_packet = Packet(self.next_seq, bitmap, ack=cumulative_ack,
+                            kind=SACK_FRAME)
 
-    def recv_one_frame(self):
-        checksum_packed = self.physical_layer.recv(4)
-        checksum_unpacked = struct.unpack("!I", checksum_packed)[0]
+        self.send_packet(new_packet)
+        self.count('acks_sent')
+
+    def update_recv_window(self, frame):
+        """
+        Update the receive window. Each stream is delivered in order on its
+        own, so a lost frame only holds up later frames on its stream.
+        """
+        seq = frame.seq
 
-        # Sequence number is next 4 bytes.
-        seq_num_packed = self.physical_layer.recv(4)
-        seq_num_unpacked = struct.unpack("!I", seq_num_packed)[0]
+        # Ignore packets which don't fit in the window
+        if seq >= self.recv_window.base + self.max_window:
+            return
 
-        # Acknowledgement number is next 4 bytes.
-        ack_num_packed = self.physical_layer.recv(4)
-        ack_num_unpacked = struct.unpack("!I", ack_num_packed)[0]
+        if seq in self.recv_window:
+            self.count('duplicates_received')
+            self.send_blank_ack(seq)
+            return
 
-        # Payload len is next byte.
-        payload_len_packed = self.physical_layer.recv(1)
-        payload_len_unpacked = struct.unpack("!B", payload_len_packed)[0]
+        # Store the packet in its slot
+        self.recv_window[seq] = frame
 
-        # Receive enough for remaining data.
-        payload = self.physical_layer.recv(payload_len_unpacked)
+        # If it is next on its stream, send it up, along with each packet
+        # which was waiting for it in turn. Otherwise it waits too.
+        if frame.prev == self.stream_delivered.get(frame.stream, NO_PREV):
+            while frame is not None:
+                self.deliver(frame)
+                waiting = self.stream_waiting.pop(frame.seq, None)
+                frame = None if waiting is None else self.recv_window[waiting]
+        else:
+            self.stream_waiting[frame.prev] = seq
 
-        # This is the data which should match the checksum.
-        to_check = seq_num_packed + ack_num_packed + payload_len_packed + \
-                   payload
+        # Everything before a gap has been delivered, so increase the base
+        # past it
+        while self.recv_window.first() is not None:
+            self.recv_window.advance()
+        self.send_blank_ack(seq)
 
-        # Compute checksum of data received.
-        observed_checksum = self.checksum(to_check, pack=False)
+    def recv_one_frame(self, frame):
+        payload = frame.payload
 
-        # Compare checksums.
-        if checksum_unpacked == observed_checksum:
+        # Checksum was verified by the frame decoder.
+        if frame.valid:
 
             if self.verbose:
-                print "Recv - SEQ:%d  ACK:%d  Size:%d" % (seq_num_unpacked,  ack_num_unpacked, payload_len_unpacked)
+                print "Recv - SEQ:%d  ACK:%d  Size:%d" % (frame.seq,  frame.ack, len(payload))
+
+            # This is a selective ack of our data.
+            if frame.kind == SACK_FRAME:
+                self.received_sack(frame.ack, payload)
+                self.count('acks_received')
 
             # This is just a blank ack of our data.
-            if payload_len_unpacked == 0:
-                self.received_ack(ack_num_unpacked)
-                self.statistics['acks_received'] += 1
+            elif len(payload) == 0:
+                self.received_ack(frame.ack)
+                self.count('acks_received')
 
             # This may be an expected data chunk
-            elif seq_num_unpacked >= self.recv_window_base:
-                recv_packet = {'seq': seq_num_unpacked, 'data' : payload}
-                self.update_recv_window(recv_packet)
+            elif frame.seq >= self.recv_window.base:
+                self.received_piggybacked_ack(frame.ack)
+                self.update_recv_window(frame)
 
             # Otherwise resend an ack for the already gotten chunk
             else :
-                self.send_blank_ack(seq_num_unpacked)
-                self.statistics['duplicates_received'] += 1
+                self.received_piggybacked_ack(frame.ack)
+                self.send_blank_ack(frame.seq)
+                self.count('duplicates_received')
 
-        elif self.verbose:
-            print "Recv - Bad checksum"
+        else:
+            # Corruption means the link is struggling, so send less at once.
+            self.shrink_window()
+            if self.verbose:
+                print "Recv - Bad checksum"
 
         # Do nothing if this didn't work.
 
     def received_ack(self, ack_num):
         """
-        Mark acked packet, or pop it from the window and move forward the send base if it's the first
+        Mark acked packet, and move forward the send base past every acked
+        packet at the front of the window
         """
-        if DEBUG:
-            if 'starwars' in self.send_window[0]['data']:
-                log_func(self)
-                print "Done"
 
-        # Do nothing if the send window is empty
-        if len(self.send_window) == 0:
-            return
-        elif self.send_window_base <= ack_num:
+        with self.window_lock:
+            # Do nothing if the send window is empty
+            if len(self.send_window) == 0:
+                return
 
-            # If the ack number is the window base remove the first packet and increase the base
-            if self.send_window_base == ack_num:
-                self.send_window.pop(0)
-                self.send_window_base += 1
+            self.mark_acked(ack_num)
+            self.slide_send_window()
 
+    def received_sack(self, cumulative_ack, bitmap):
+        """
+        Mark every packet a selective ack covers, then move forward the
+        send base
+        """
 
-                # Remove all consecutive acked packets whose sequence values match the increasing base
-                while len(self.send_window) > 0 and self.send_window[0]['acked'] == True:
-                    self.send_window.pop(0)
-                    self.send_window_base += 1
-            else:
+        with self.window_lock:
+            # Do nothing if the send window is empty
+            if len(self.send_window) == 0:
+                return
 
-                # Mark the packet with the matching sequence number acked
-                for packet in self.send_window:
-                    if packet['seq'] == ack_num:
-                        packet['acked'] = True
-                        return
+            # Everything before the cumulative ack has arrived.
+            for seq in xrange(self.send_window.base,
+                              min(cumulative_ack, self.send_window.end)):
+                self.mark_acked(seq)
 
-    def resend_on_timeout(self, seqnum):
+            # So has everything marked in the bitmap.
+            for seq in decode_sack(cumulative_ack, bitmap):
+                self.mark_acked(seq)
 
-        # If the timer runs out on an unacked packet resend
-        if self.send_window_base <= seqnum:
-            for packet in self.send_window:
-                if packet['seq'] == seqnum:
-                    if packet['acked'] == False:
-                        self.send_packet(packet)
-                        self.statistics['retransmissions'] += 1
-                        self.start_timer_for(seqnum)
+            self.slide_send_window()
 
-    def send(self, data):
+    def received_piggybacked_ack(self, cumulative_ack):
         """
-        Send data through the data-link layer.
+        Data frames carry a cumulative ack: everything before it arrived.
         """
 
-        if len(data) > 256:
-            raise Exception('Chunk from application too large.')
+        with self.window_lock:
+            if cumulative_ack > self.send_window.base:
+                self.received_sack(cumulative_ack, '')
 
-        # Block until the window can take one more packet.
-        while len(self.send_window) + 1 > self.window_len:
-            time.sleep(0.001)
+    def mark_acked(self, seq):
+        """
+        Mark one sent packet as acked.
+        """
 
-        # New item to add to the window.
-        new_packet = {'seq': self.next_seq, 'ack': 0, 'acked': False, 'data': data}
+        # Ignore acks for packets outside the window, or already acked.
+        packet = self.send_window[seq]
+        if packet is None or packet.acked:
+            return
 
-        # Put the given data at the end of the window.
-        self.send_window.append(new_packet)
+        # The packet is acked, so stop its timer.
+        self.stop_timer_for(seq)
+        self.backed_off.discard(seq)
+        self.sample_rtt(packet)
+        self.acked(packet)
+        self.grow_window()
+        packet.acked = True
+
+    def slide_send_window(self):
+        # Remove all consecutive acked packets at the base of the window
+        slid = False
+        while len(self.send_window) > 0 and self.send_window.first().acked:
+            self.send_window.advance()
+            slid = True
+
+        if slid:
+            self.window_opened()
+
+            # The link is delivering again, so undo the backoff, including
+            # that of packets which timed out and are still waiting.
+            self.rtt.reset_backoff()
+            self.metrics.set('rto', self.rtt.rto)
+            for seq in self.backed_off:
+                packet = self.send_window[seq]
+                packet.timeout = self.rtt.rto
+                self.start_timer_for(seq, packet.timeout)
+            self.backed_off.clear()
 
-        # Send it along the physical layer.
-        self.send_packet(new_packet)
+    def resend_on_timeout(self, seqnum):
+        with self.window_lock:
+            # If the timer runs out on an unacked packet resend
+            packet = self.send_window[seqnum]
+            if packet is not None and not packet.acked:
+                self.retransmitting(packet)
+                self.send_packet(packet)
+                self.shrink_window()
+
+                # Back off this packet's timer only, since the others in the
+                # window are timed separately.
+                packet.timeout = self.rtt.backed_off(packet.timeout)
+                self.start_timer_for(seqnum, packet.timeout)
+                self.backed_off.add(seqnum)
+
+    def send_frame(self, data, stream=0):
+        """
+        Send one frame's worth of data on a stream through the data-link
+        layer.
+        """
+
+        with self.window_lock:
+            # Block until the window can take one more packet.
+            if not self.wait_for_window():
+                return
+
+            # New item to add to the window.
+            prev = self.prev_on_stream(stream, self.next_seq)
+            new_packet = Packet(self.next_seq, data, stream=stream,
+                                prev=prev, sent_at=time.time(),
+                                timeout=self.rtt.rto)
 
-        # Start timer for packet
-        self.start_timer_for(self.next_seq)
+            # Put the given data at the end of the window.
+            self.send_window.append(new_packet)
+            self.metrics.observe('window_occupancy', len(self.send_window))
 
-        # Increment the sequence
-        self.next_seq += 1
+            # Send it along the physical layer.
+            self.send_packet(new_packet)
+            self.send_parity(new_packet)
+
+            # Start timer for packet
+            self.start_timer_for(self.next_seq, new_packet.timeout)
+
+            # Increment the sequence
+            self.next_seq += 1
 
     def send_packet(self, pk):
-        packet = self.build_packet(pk['data'], pk['seq'], pk['ack'])
-        self.statistics['frames_transmitted'] += 1
+        ack = pk.ack
+
+        # Data frames carry our cumulative ack. If nothing beyond it is
+        # buffered, that says all a selective ack would, so any owed ack
+        # rides along. Claim the ack before reading what has been received,
+        # so an ack owed for anything newer is never claimed by mistake.
+        if pk.kind == DATA_FRAME and pk.data:
+            owed = self.sack and self.clear_pending_ack()
+            ack = self.recv_window.base
+            if owed and self.recv_window.end == ack:
+                self.count('acks_piggybacked')
+            elif owed:
+                self.restore_pending_ack()
+
+        packet = pk.encode(ack, self.checksum)
+        self.count('frames_transmitted')
 
         if self.verbose:
-            print "Send - SEQ:%d  ACK:%d  Size:%d" % (pk['seq'], pk['ack'],
-                                                      len(pk['data']))
+            print "Send - SEQ:%d  ACK:%d  Size:%d" % (pk.seq, ack,
+                                                      len(pk.data))
+        self.count('frame_bytes_sent', len(packet))
         self.physical_layer.send(packet)
-
-    def start_timer_for(self, seqnum):
-        t = Timer(0.1, self.resend_on_timeout, [seqnum])
-        t.start()
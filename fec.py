@@ -0,0 +1,178 @@
+import binascii
+
+from framing import PARITY_HEADER
+
+
+def to_int(data):
+    """
+    Returns `data` as a little-endian integer. XORing two of these lines up
+    their first bytes, as if the shorter one were padded with zeroes.
+    """
+    if not data:
+        return 0
+    return int(binascii.hexlify(data[::-1]), 16)
+
+
+def from_int(value, length):
+    """
+    Returns the first `length` bytes of a little-endian integer.
+    """
+    digits = ('%x' % value)[-2 * length:]
+    digits = '0' * (2 * length - len(digits)) + digits
+    return binascii.unhexlify(digits)[::-1]
+
+
+class ParityEncoder(object):
+    """
+    Builds parity frames for a sender.
+
+    Data frames are grouped k at a time by sequence number, and each group
+    gets m parity frames. Parity frame i covers every m-th frame of the
+    group starting from frame i, so the receiver can rebuild one lost frame
+    from each of them.
+    """
+
+    def __init__(self, k, m):
+        if not 0 < m <= k <= 255:
+            raise Exception('FEC needs 0 < parity frames <= group size '
+                            '<= 255.')
+
+        self.k = k
+        self.m = m
+        self.start_group(0)
+
+    def start_group(self, base):
+        self.base = base
+
+        # Running XOR of the payloads and of their lengths, and the longest
+        # payload, for each parity frame.
+        self.values = [0] * self.m
+        self.lengths = [0] * self.m
+        self.widths = [0] * self.m
+
+    def add(self, seq, payload):
+        """
+        Account for a data frame on its first transmission. Returns a list
+        of (group base, index, payload) for each parity frame to send, once
+        `seq` completes its group.
+        """
+        offset = seq % self.k
+        if seq - offset != self.base:
+            self.start_group(seq - offset)
+
+        index = offset % self.m
+        self.values[index] ^= to_int(payload)
+        self.lengths[index] ^= len(payload)
+        self.widths[index] = max(self.widths[index], len(payload))
+
+        if offset != self.k - 1:
+            return []
+
+        parities = [(self.base, index,
+                     PARITY_HEADER.pack(self.k, self.m, self.lengths[index]) +
+                     from_int(self.values[index], self.widths[index]))
+                    for index in xrange(self.m)]
+
+        self.start_group(self.base + self.k)
+        return parities
+
+
+class ParityDecoder(object):
+    """
+    Rebuilds lost data frames for a receiver from parity frames.
+
+    Recent data frames are kept by sequence number, whether or not the
+    protocol accepted them. A parity frame missing exactly one of the frames
+    it covers rebuilds it at once, and one missing more waits until all but
+    one of them have arrived.
+    """
+
+    def __init__(self):
+        # Data frames still needed to rebuild others, by sequence number.
+        self.received = {}
+
+        # Parity frames waiting on more than one frame, by (base, index).
+        self.parities = {}
+
+        # Frames per group, once a parity frame has said. Frames below
+        # `low` have been forgotten.
+        self.k = 0
+        self.low = 0
+
+    def add_data(self, seq, payload):
+        """
+        Remember a data frame. Returns a list of (seq, payload) for any
+        frames it let us rebuild.
+        """
+        if seq < self.low or seq in self.received:
+            return []
+        self.received[seq] = payload
+
+        recovered = []
+        for key, parity in self.parities.items():
+            if seq in self.covered(key, parity):
+                recovered.extend(self.try_recover(key, parity))
+        return recovered
+
+    def add_parity(self, base, index, payload):
+        """
+        Handle a parity frame. Returns a list of (seq, payload) for any
+        frames it let us rebuild.
+        """
+        if len(payload) < PARITY_HEADER.size:
+            return []
+
+        self.k = PARITY_HEADER.unpack_from(payload)[0]
+        return self.try_recover((base, index), payload)
+
+    def covered(self, key, parity):
+        base, index = key
+        k, m, _ = PARITY_HEADER.unpack_from(parity)
+        return xrange(base + index, base + k, m)
+
+    def try_recover(self, key, parity):
+        covered = self.covered(key, parity)
+
+        # Forgotten frames can't be XORed back out.
+        if any(seq < self.low for seq in covered):
+            self.parities.pop(key, None)
+            return []
+
+        missing = [seq for seq in covered if seq not in self.received]
+        if len(missing) != 1:
+            # Nothing lost, or too much to rebuild yet.
+            if missing:
+                self.parities[key] = parity
+            else:
+                self.parities.pop(key, None)
+            return []
+
+        self.parities.pop(key, None)
+
+        # XOR the others back out of the parity to leave the lost frame.
+        length = PARITY_HEADER.unpack_from(parity)[2]
+        value = to_int(parity[PARITY_HEADER.size:])
+        for seq in covered:
+            if seq != missing[0]:
+                length ^= len(self.received[seq])
+                value ^= to_int(self.received[seq])
+
+        payload = from_int(value, length)
+        self.received[missing[0]] = payload
+        return [(missing[0], payload)]
+
+    def discard_before(self, seq):
+        """
+        Forget frames no longer needed once everything before `seq` has been
+        delivered. Groups are kept whole, since a late parity frame may
+        still need their delivered frames.
+        """
+        if self.k:
+            seq -= seq % self.k
+
+        for old in xrange(self.low, seq):
+            self.received.pop(old, None)
+        self.low = max(self.low, seq)
+
+        for key in [key for key in self.parities if key[0] < self.low]:
+            del self.parities[key]
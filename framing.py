@@ -0,0 +1,391 @@
+# The struct library is used for packing exact binary data.
+# https://docs.python.org/2/library/struct.html
+import struct
+from collections import namedtuple, deque
+
+from checksums import crc32_checksum
+
+
+# Wire layout of a data-link frame header: checksum, header check, frame
+# kind, stream, sequence number, acknowledgement number, previous sequence
+# number on the same stream, payload length. The checksum covers everything
+# after it, including the payload. The header check covers just the fields
+# after it, so a corrupt length can be caught before waiting for a payload
+# that will never come.
+FRAME_HEADER = struct.Struct("!IHBBIIIH")
+
+# The header check, and the fields it covers, used when building a frame.
+HEADER_CHECK = struct.Struct("!H")
+HEADER_FIELDS = struct.Struct("!BBIIIH")
+
+# Number of leading header bytes not covered by the checksum.
+CHECKSUM_SIZE = 4
+
+# Offset of the fields covered by the header check.
+HEADER_FIELDS_OFFSET = CHECKSUM_SIZE + HEADER_CHECK.size
+
+# Previous sequence number of the first frame on a stream. Each stream is
+# delivered in order on its own, so a lost frame only holds up its stream.
+NO_PREV = 0xFFFFFFFF
+
+# Largest whole frame we allow: the biggest payload a UDP datagram can
+# carry.
+MAX_FRAME_SIZE = 65507
+
+# Frame kinds. A data frame with no payload is a bare ack.
+DATA_FRAME = 0
+
+# Selective ack: the ack number is cumulative, and the payload is a bitmap
+# of the frames received beyond it. See `encode_sack`.
+SACK_FRAME = 1
+
+# Opening handshake: the sender's offer of connection parameters. These are
+# sent before the two ends have agreed on a checksum, so always use CRC-32.
+# See handshake.py.
+HELLO_FRAME = 2
+
+# Forward error correction: the XOR of some of the data frames in a group,
+# from which a lost one can be rebuilt. The sequence number is the first in
+# the group and the ack number says which of its parity frames this is. See
+# fec.py.
+PARITY_FRAME = 3
+
+FRAME_KINDS = (DATA_FRAME, SACK_FRAME, HELLO_FRAME, PARITY_FRAME)
+
+# Wire layout of a handshake payload: version, flags, bitmasks of the
+# protocols and checksums supported, largest frame size, window, largest
+# window and ack delay in milliseconds.
+HELLO = struct.Struct("!BBBBHHHH")
+HELLO_VERSION = 1
+
+# Handshake flags. HELLO_HAVE_PEER is set once the sender has the receiver's
+# offer, so the receiver need not answer it.
+HELLO_HAVE_PEER = 1
+HELLO_SACK = 2
+
+# Wire layout of the start of a parity payload: frames per group, parity
+# frames per group, and the XOR of the lengths of the frames covered. The
+# XOR of their payloads follows.
+PARITY_HEADER = struct.Struct("!BBH")
+
+# Parity covers each data frame's stream and previous sequence number as
+# well as its payload, so a rebuilt frame is delivered to the right place.
+PARITY_RECORD = struct.Struct("!BI")
+
+# A decoded frame. `valid` is False when the checksum did not match.
+Frame = namedtuple('Frame', ['valid', 'kind', 'stream', 'seq', 'ack', 'prev',
+                             'payload'])
+
+
+class Packet(object):
+    """
+    A frame we send, kept until it is acked.
+
+    The wire bytes are encoded once and reused for every retransmission.
+    Only the ack number a frame carries can go stale, so they are encoded
+    again only when it has moved on.
+    """
+    __slots__ = ('seq', 'ack', 'data', 'kind', 'stream', 'prev', 'sent_at',
+                 'timeout', 'acked', 'retransmitted', 'wire', 'wire_ack')
+
+    def __init__(self, seq, data, ack=0, kind=DATA_FRAME, stream=0,
+                 prev=NO_PREV, sent_at=0.0, timeout=0.0):
+        self.seq = seq
+        self.ack = ack
+        self.data = data
+        self.kind = kind
+        self.stream = stream
+        self.prev = prev
+
+        # When it was first sent, and how long until it is resent.
+        self.sent_at = sent_at
+        self.timeout = timeout
+
+        self.acked = False
+        self.retransmitted = False
+
+        # Encoded frame, and the ack number it carries.
+        self.wire = None
+        self.wire_ack = None
+
+    def encode(self, ack, checksum):
+        """
+        Returns the wire bytes of the packet carrying ack number `ack`.
+        """
+        if self.wire is None or self.wire_ack != ack:
+            self.wire = encode_frame(self.seq, ack, self.data, checksum,
+                                     self.kind, self.stream, self.prev)
+            self.wire_ack = ack
+
+        return self.wire
+
+
+def encode_frame(seq, ack, payload, checksum, kind=DATA_FRAME, stream=0,
+                 prev=NO_PREV):
+    """
+    Returns the wire bytes of a frame as a bytearray, using `checksum` to
+    compute its checksum.
+
+    The payload may be any buffer, such as a memoryview slice of a larger
+    message. It is copied exactly once, into the frame, and the header is
+    packed and checksummed in place around it.
+    """
+    frame = bytearray(FRAME_HEADER.size + len(payload))
+    frame[FRAME_HEADER.size:] = payload
+
+    # Fill in the fields, then the check covering just them.
+    HEADER_FIELDS.pack_into(frame, HEADER_FIELDS_OFFSET,
+                            kind, stream, seq, ack, prev, len(payload))
+    fields = buffer(frame, HEADER_FIELDS_OFFSET, HEADER_FIELDS.size)
+    HEADER_CHECK.pack_into(frame, CHECKSUM_SIZE,
+                           checksum(fields, pack=False) & 0xffff)
+
+    # The checksum covers everything after it.
+    frame[:CHECKSUM_SIZE] = checksum(buffer(frame, CHECKSUM_SIZE))
+
+    return frame
+
+
+def hello_checksum(data, pack=True):
+    """
+    Returns the checksum of a handshake frame, which is always CRC-32.
+    """
+    checksum = crc32_checksum(data)
+
+    if pack:
+        return struct.pack("!I", checksum)
+    else:
+        return checksum
+
+
+def encode_sack(cumulative_ack, received, max_len):
+    """
+    Returns the bitmap payload of a selective ack, at most `max_len` bytes.
+    Bit i is set if frame cumulative_ack + 1 + i is in the `received`
+    sequence numbers. Frame cumulative_ack itself is the first one missing,
+    so needs no bit.
+    """
+    bitmap = bytearray()
+
+    for seq in received:
+        bit = seq - cumulative_ack - 1
+        if bit < 0:
+            continue
+
+        # Stop where the bitmap would no longer fit in one frame.
+        byte = bit // 8
+        if byte >= max_len:
+            break
+
+        if byte >= len(bitmap):
+            bitmap.extend(bytearray(byte + 1 - len(bitmap)))
+        bitmap[byte] |= 1 << (bit % 8)
+
+    return bytes(bitmap)
+
+
+def decode_sack(cumulative_ack, bitmap):
+    """
+    Yields the sequence numbers marked as received in a selective ack
+    bitmap.
+    """
+    for byte_index, byte in enumerate(bytearray(bitmap)):
+        if not byte:
+            continue
+        for bit in xrange(8):
+            if byte & (1 << bit):
+                yield cumulative_ack + 1 + byte_index * 8 + bit
+
+
+class FrameDecoder(object):
+    """
+    Splits the byte stream from a physical layer into frames.
+
+    Each header is read and unpacked in one operation, and the checksum runs
+    directly over the received bytes without rebuilding them. Every complete
+    frame already buffered is decoded in the same pass.
+    """
+
+    def __init__(self, physical_layer, checksum, max_payload):
+        self.physical_layer = physical_layer
+        self.checksum = checksum
+
+        # Headers claiming a longer payload than this are corrupt.
+        self.max_payload = max_payload
+
+        # Set after a bad frame, until the decoder finds a good one again.
+        self.resyncing = False
+
+        # Bytes received but not yet decoded are self.pending[self.offset:].
+        self.pending = ""
+        self.offset = 0
+
+    def checks_for(self, kind):
+        """
+        Returns the checksum function and largest payload for a kind of
+        frame. Handshake frames have their own, since they come before the
+        connection's are agreed.
+        """
+        if kind == HELLO_FRAME:
+            return hello_checksum, HELLO.size
+        else:
+            return self.checksum, self.max_payload
+
+    def fill(self, n, block):
+        """
+        Make sure at least n undecoded bytes are pending, pulling from the
+        physical layer. Returns False if that would mean blocking, unless
+        `block` is set.
+        """
+        available = len(self.pending) - self.offset
+        if available >= n:
+            return True
+
+        got = self.physical_layer.recv_available(n - available if block
+                                                 else 0)
+        self.pending = self.pending[self.offset:] + got
+        self.offset = 0
+
+        return len(self.pending) >= n
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for more to decode.
+        """
+        self.physical_layer.wait_for_data(max(timeout, 0))
+
+    def decode_one(self, block):
+        """
+        Decode the next frame, or return None if it is not fully buffered
+        and `block` is not set.
+
+        A bad frame is reported once. Since its length may be what got
+        corrupted, the decoder then slides forward a byte at a time until a
+        good frame lines up again, skipping the bytes in between.
+        """
+        while True:
+            if not self.fill(FRAME_HEADER.size, block):
+                return None
+
+            checksum, header_check, kind, stream, seq, ack, prev, \
+                payload_len = FRAME_HEADER.unpack_from(self.pending,
+                                                       self.offset)
+
+            valid = False
+            payload = ""
+
+            frame_checksum, max_payload = self.checks_for(kind)
+
+            # Only wait for the payload if the header itself is intact.
+            fields = buffer(self.pending, self.offset + HEADER_FIELDS_OFFSET,
+                            HEADER_FIELDS.size)
+            header_ok = \
+                header_check == frame_checksum(fields, pack=False) & 0xffff
+
+            if header_ok and kind in FRAME_KINDS and \
+                    payload_len <= max_payload:
+                frame_len = FRAME_HEADER.size + payload_len
+                if not self.fill(frame_len, block):
+                    return None
+
+                start = self.offset
+                payload = self.pending[start + FRAME_HEADER.size:
+                                       start + frame_len]
+
+                # Checksum the received bytes in place.
+                checked = buffer(self.pending, start + CHECKSUM_SIZE,
+                                 frame_len - CHECKSUM_SIZE)
+                valid = checksum == frame_checksum(checked, pack=False)
+
+            if valid:
+                self.resyncing = False
+                self.offset += frame_len
+                return Frame(True, kind, stream, seq, ack, prev, payload)
+
+            # Look for the next frame starting one byte later.
+            self.offset += 1
+            if not self.resyncing:
+                self.resyncing = True
+                return Frame(False, kind, stream, seq, ack, prev, payload)
+
+    def decode(self):
+        """
+        Block until a frame arrives, then return a list of it and every
+        other complete frame already buffered. Returns an empty list once
+        the connection has ended.
+        """
+        frame = self.decode_one(block=True)
+        if frame is None:
+            return []
+
+        frames = [frame]
+
+        while True:
+            frame = self.decode_one(block=False)
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+
+class DatagramDecoder(FrameDecoder):
+    """
+    Decodes frames from a physical layer which delivers each one as a
+    datagram of its own. Frame boundaries come for free, so a bad frame
+    never costs the ones after it, and there is nothing to resync.
+    """
+
+    def __init__(self, physical_layer, checksum, max_payload):
+        super(DatagramDecoder, self).__init__(physical_layer, checksum,
+                                              max_payload)
+
+        # Datagrams received but not yet decoded.
+        self.datagrams = deque()
+
+    def wait(self, timeout):
+        """
+        Wait up to `timeout` seconds for a datagram to decode.
+        """
+        if not self.datagrams:
+            self.datagrams.extend(
+                self.physical_layer.recv_datagrams(True, max(timeout, 0)))
+
+    def decode_one(self, block):
+        """
+        Decode the next datagram, or return None if none has arrived and
+        `block` is not set.
+        """
+        if not self.datagrams:
+            self.datagrams.extend(self.physical_layer.recv_datagrams(block))
+            if not self.datagrams:
+                return None
+
+        datagram = self.datagrams.popleft()
+
+        if len(datagram) < FRAME_HEADER.size:
+            return Frame(False, DATA_FRAME, 0, 0, 0, NO_PREV, "")
+
+        checksum, header_check, kind, stream, seq, ack, prev, payload_len = \
+            FRAME_HEADER.unpack_from(datagram)
+        frame_checksum, max_payload = self.checks_for(kind)
+
+        # The header must be intact and account for the whole datagram.
+        fields = buffer(datagram, HEADER_FIELDS_OFFSET, HEADER_FIELDS.size)
+        valid = kind in FRAME_KINDS and \
+            payload_len == len(datagram) - FRAME_HEADER.size and \
+            payload_len <= max_payload and \
+            header_check == frame_checksum(fields, pack=False) & 0xffff and \
+            checksum == frame_checksum(buffer(datagram, CHECKSUM_SIZE),
+                                       pack=False)
+
+        return Frame(valid, kind, stream, seq, ack, prev,
+                     datagram[FRAME_HEADER.size:] if valid else "")
+
+
+def make_decoder(physical_layer, checksum, max_payload):
+    """
+    Returns the right kind of frame decoder for a physical layer.
+    """
+    if physical_layer.datagrams:
+        return DatagramDecoder(physical_layer, checksum, max_payload)
+    else:
+        return FrameDecoder(physical_layer, checksum, max_payload)
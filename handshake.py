@@ -0,0 +1,195 @@
+import time
+from collections import namedtuple
+
+from checksums import CHECKSUM_PREFERENCE
+from datalink import DataLinkLayer_GBN, DataLinkLayer_SR
+from framing import make_decoder, encode_frame, hello_checksum, HELLO_FRAME, \
+    HELLO, HELLO_VERSION, HELLO_HAVE_PEER, HELLO_SACK
+from utils import *
+
+
+# Protocol names from most to least preferred. Every end supports GBN.
+PROTOCOLS = ['sr', 'gbn']
+
+# What one end is willing to use for a connection. `protocols` and
+# `checksums` are lists of names. A window of zero means the chosen
+# protocol's default, and a largest window of zero means the same as the
+# window. The ack delay is in seconds.
+Offer = namedtuple('Offer', ['protocols', 'checksums', 'max_frame_size',
+                             'window_len', 'max_window', 'sack', 'ack_delay'])
+
+
+def to_mask(names, ordered):
+    """
+    Returns a bitmask with bit i set if ordered[i] is in `names`.
+    """
+    return sum(1 << i for i, name in enumerate(ordered) if name in names)
+
+
+def from_mask(mask, ordered):
+    """
+    Returns the names in `ordered` whose bits are set in `mask`.
+    """
+    return [name for i, name in enumerate(ordered) if mask & (1 << i)]
+
+
+def encode_offer(offer, have_peer):
+    """
+    Returns the handshake payload for an offer. `have_peer` says we already
+    have the other end's offer.
+    """
+    flags = 0
+    if have_peer:
+        flags |= HELLO_HAVE_PEER
+    if offer.sack:
+        flags |= HELLO_SACK
+
+    return HELLO.pack(HELLO_VERSION, flags,
+                      to_mask(offer.protocols, PROTOCOLS),
+                      to_mask(offer.checksums, CHECKSUM_PREFERENCE),
+                      offer.max_frame_size, offer.window_len,
+                      offer.max_window, int(round(offer.ack_delay * 1000)))
+
+
+def decode_offer(payload):
+    """
+    Returns the offer in a handshake payload, and whether its sender already
+    has ours.
+    """
+    version, flags, protocols, checksums, max_frame_size, window_len, \
+        max_window, ack_delay = HELLO.unpack(payload)
+
+    if version != HELLO_VERSION:
+        raise Exception('Other end speaks handshake version %d, not %d.' %
+                        (version, HELLO_VERSION))
+
+    offer = Offer(from_mask(protocols, PROTOCOLS),
+                  from_mask(checksums, CHECKSUM_PREFERENCE),
+                  max_frame_size, window_len, max_window,
+                  bool(flags & HELLO_SACK), ack_delay / 1000.0)
+
+    return offer, bool(flags & HELLO_HAVE_PEER)
+
+
+def negotiate(ours, theirs):
+    """
+    Returns the settings for a connection between two offers: the best
+    protocol and checksum both support, and the smaller of each limit. Both
+    ends compute the same settings from the same pair of offers.
+    """
+    protocols = [name for name in PROTOCOLS
+                 if name in ours.protocols and name in theirs.protocols]
+    checksums = [name for name in CHECKSUM_PREFERENCE
+                 if name in ours.checksums and name in theirs.checksums]
+
+    if not protocols:
+        raise Exception('No protocol supported by both ends.')
+    if not checksums:
+        raise Exception('No checksum supported by both ends.')
+
+    protocol = protocols[0]
+    default_window = SR_WINDOW_LEN if protocol == 'sr' else GBN_WINDOW_LEN
+
+    # Each end's window, and the largest it may grow to.
+    windows = []
+    for offer in (ours, theirs):
+        window_len = offer.window_len or default_window
+        windows.append((window_len, max(offer.max_window, window_len)))
+
+    return {
+        'protocol': protocol,
+        'checksum': checksums[0],
+        'max_frame_size': min(ours.max_frame_size, theirs.max_frame_size),
+        'window_len': min(window for window, _ in windows),
+        'max_window': min(max_window for _, max_window in windows),
+        'sack': ours.sack and theirs.sack,
+        'ack_delay': min(ours.ack_delay, theirs.ack_delay)
+    }
+
+
+def handshake(physical_layer, offer, timeout=HANDSHAKE_TIMEOUT):
+    """
+    Exchange offers with the other end of the physical layer, resending
+    ours until theirs arrives. Returns the negotiated settings, the frame
+    decoder to carry on with, and our handshake frame for answering the
+    other end if it is still waiting for our offer.
+
+    Both ends run the same exchange, so neither needs to be the client. Any
+    data which arrives first, from an end which has already finished, is
+    skipped and will be retransmitted by its sender.
+    """
+
+    # Until the format is agreed, only handshake frames can be checked.
+    frame_decoder = make_decoder(physical_layer, hello_checksum, 0)
+
+    hello = encode_frame(0, 0, encode_offer(offer, False), hello_checksum,
+                         HELLO_FRAME)
+
+    deadline = time.time() + timeout
+    next_send = 0
+
+    while True:
+        now = time.time()
+        if now > deadline:
+            raise Exception('Handshake timed out.')
+
+        # Keep offering until the other end answers.
+        if now >= next_send:
+            physical_layer.send(hello)
+            next_send = now + HANDSHAKE_RETRY
+
+        frame = frame_decoder.decode_one(block=False)
+        if frame is None:
+            # Nothing more will arrive once the other end has gone.
+            if physical_layer.received_data_buffer.closed:
+                raise Exception('Connection ended during handshake.')
+
+            # Sleep until something arrives or it is time to offer again.
+            frame_decoder.wait(min(next_send, deadline) - time.time())
+            continue
+
+        if frame.valid and frame.kind == HELLO_FRAME and \
+                len(frame.payload) == HELLO.size:
+            break
+
+    theirs, they_have_ours = decode_offer(frame.payload)
+    settings = negotiate(offer, theirs)
+
+    # From now on our offer says we have theirs, so they needn't answer it.
+    hello = encode_frame(0, 0, encode_offer(offer, True), hello_checksum,
+                         HELLO_FRAME)
+    if not they_have_ours:
+        physical_layer.send(hello)
+
+    return settings, frame_decoder, hello
+
+
+def open_datalink(physical_layer, verbose, offer, adaptive_window=False,
+                  dup_ack_threshold=DUP_ACK_THRESHOLD, fec_k=0,
+                  fec_m=DEFAULT_FEC_PARITY):
+    """
+    Handshake with the other end, then return a data-link layer using the
+    settings agreed. Adaptive windows, the GBN duplicate ack threshold and
+    forward error correction only affect our own sending, so they are not
+    negotiated. Parity frames describe their own groups.
+    """
+    settings, frame_decoder, hello = handshake(physical_layer, offer)
+
+    debug_log("Negotiated %s." % settings)
+
+    protocol = settings.pop('protocol')
+    sack = settings.pop('sack')
+
+    if protocol == 'sr':
+        return DataLinkLayer_SR(physical_layer, verbose, sack=sack,
+                                adaptive_window=adaptive_window,
+                                fec_k=fec_k, fec_m=fec_m,
+                                frame_decoder=frame_decoder, hello=hello,
+                                **settings)
+    else:
+        return DataLinkLayer_GBN(physical_layer, verbose,
+                                 dup_ack_threshold=dup_ack_threshold,
+                                 adaptive_window=adaptive_window,
+                                 fec_k=fec_k, fec_m=fec_m,
+                                 frame_decoder=frame_decoder, hello=hello,
+                                 **settings)
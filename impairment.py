@@ -0,0 +1,150 @@
+import random
+
+
+class BernoulliLoss(object):
+    """
+    Loses each frame independently, at a fixed rate.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def lose(self, rng):
+        # Don't give a chance to drop if rate is 0.0.
+        if self.rate == 0.0:
+            return False
+
+        return rng.random() < self.rate
+
+
+class GilbertElliottLoss(object):
+    """
+    Loses frames in bursts. The link is either good or bad, and moves from
+    good to bad with probability `p` and back with probability `r` before
+    each frame. Frames are lost at `good_loss` in the good state and
+    `bad_loss` in the bad one.
+    """
+
+    def __init__(self, p, r, good_loss=0.0, bad_loss=1.0):
+        self.p = p
+        self.r = r
+        self.good_loss = good_loss
+        self.bad_loss = bad_loss
+
+        # Links start out good.
+        self.bad = False
+
+    def lose(self, rng):
+        if self.bad:
+            if rng.random() < self.r:
+                self.bad = False
+        elif rng.random() < self.p:
+            self.bad = True
+
+        return rng.random() < (self.bad_loss if self.bad else self.good_loss)
+
+
+class Impairment(object):
+    """
+    Decides what happens to each frame a physical layer sends: whether it is
+    lost, whether one of its bytes is changed, and how long it takes to go
+    out.
+
+    Every decision comes from one random number generator, so two runs with
+    the same seed and the same frames are impaired the same way. Rates are
+    percentages, like the --drop and --corrupt command line parameters, and
+    times are in seconds.
+    """
+
+    def __init__(self, drop_rate=0, corrupt_rate=0, seed=None, loss=None,
+                 delay=0.0, jitter=0.0, reorder_rate=0, reorder_delay=0.0,
+                 bandwidth=0, bucket_size=0):
+        self.random = random.Random(seed)
+
+        # Independent loss at the drop rate, unless another model is given.
+        self.loss = loss or BernoulliLoss(float(drop_rate) / 100)
+
+        self.corrupt_rate = float(corrupt_rate) / 100
+
+        # Every frame is held for `delay` plus up to `jitter` more. Frames
+        # picked for reordering are held a further `reorder_delay`, so ones
+        # sent after them go first.
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder_rate = float(reorder_rate) / 100
+        self.reorder_delay = reorder_delay
+
+        # Token bucket limiting the link to `bandwidth` bytes per second,
+        # with bursts of up to `bucket_size` bytes. Zero means no limit. A
+        # frame bigger than the tokens left goes out once they have built
+        # back up, and the frames behind it wait their turn.
+        self.bandwidth = bandwidth
+        self.bucket_size = bucket_size
+        self.tokens = bucket_size
+        self.last_refill = None
+
+    def decide_to_drop(self):
+        """
+        Returns True if the next frame should be lost.
+        """
+        return self.loss.lose(self.random)
+
+    def maybe_corrupt(self, data):
+        """
+        Returns `data` back, possibly with one byte changed.
+        """
+
+        # Don't give it a chance to corrupt if rate is 0.0.
+        if self.corrupt_rate == 0.0 or not data:
+            return data
+
+        # If random doesn't pass rate, then return without corrupting.
+        if self.random.random() > self.corrupt_rate:
+            return data
+
+        # Select data index to corrupt.
+        corrupt_index = self.random.randint(0, len(data) - 1)
+
+        # Corrupt a copy of the data and return it, since the caller may
+        # still hold the original for retransmission. Flipping bits makes
+        # sure the byte really changes.
+        c_data = bytearray(data)
+        c_data[corrupt_index] ^= self.random.randint(1, 255)
+
+        return c_data
+
+    def delay_for(self, size, now):
+        """
+        Returns how many seconds a frame of `size` bytes, sent at `now`,
+        should be held before it goes out.
+        """
+        delay = self.delay
+
+        if self.jitter:
+            delay += self.random.uniform(0, self.jitter)
+
+        if self.reorder_rate and self.random.random() < self.reorder_rate:
+            delay += self.reorder_delay
+
+        if self.bandwidth:
+            delay += self.shape(size, now)
+
+        return delay
+
+    def shape(self, size, now):
+        """
+        Take a frame's worth of tokens from the bucket, and return how long
+        the frame must wait for them.
+        """
+        if self.last_refill is not None:
+            self.tokens = min(self.bucket_size,
+                              self.tokens +
+                              (now - self.last_refill) * self.bandwidth)
+        self.last_refill = now
+
+        # Tokens go negative while frames are waiting for them.
+        self.tokens -= size
+        if self.tokens >= 0:
+            return 0.0
+
+        return -self.tokens / float(self.bandwidth)
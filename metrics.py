@@ -0,0 +1,383 @@
+import os
+import json
+import time
+import socket
+import itertools
+import traceback
+from threading import Thread, Lock
+
+from utils import *
+
+
+class Histogram(object):
+    """
+    Counts values in buckets whose width grows with the values, like an HDR
+    histogram. Values are whole multiples of `unit`. Below 2 ** sub_bits
+    units each value has a bucket of its own, and every power of two above
+    that is split into 2 ** sub_bits equal buckets. So any value is recorded
+    to within 1 / 2 ** sub_bits of itself, and only buckets which have been
+    used take any memory.
+    """
+
+    def __init__(self, unit, sub_bits=HISTOGRAM_SUB_BITS):
+        self.unit = unit
+        self.sub_bits = sub_bits
+        self.sub_buckets = 1 << sub_bits
+
+        # Count of values in each bucket used, by bucket index.
+        self.counts = {}
+
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        """
+        Returns the index of the bucket `value` falls in.
+        """
+        units = max(int(value / self.unit), 0)
+        if units < self.sub_buckets:
+            return units
+
+        # Keep the top sub_bits + 1 bits of the value.
+        shift = units.bit_length() - self.sub_bits - 1
+        top = units >> shift
+        return (shift + 1) * self.sub_buckets + top - self.sub_buckets
+
+    def upper_bound(self, index):
+        """
+        Returns the smallest value too big for bucket `index`.
+        """
+        if index < self.sub_buckets:
+            units = index + 1
+        else:
+            shift = index // self.sub_buckets - 1
+            top = index % self.sub_buckets + self.sub_buckets
+            units = (top + 1) << shift
+
+        # Units like 1e-6 can't be held exactly, so don't let the rounding
+        # show.
+        return round(units * self.unit, 9)
+
+    def record(self, value):
+        index = self.bucket(value)
+        self.counts[index] = self.counts.get(index, 0) + 1
+
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        Returns a value at least as big as p percent of those recorded.
+        """
+        if not self.count:
+            return 0.0
+
+        wanted = self.count * p / 100.0
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                return min(self.upper_bound(index), self.max)
+
+        return self.max
+
+    def buckets(self):
+        """
+        Returns (upper bound, count of values below it) for each power of two
+        used, in order, as a Prometheus histogram reports them. Reporting
+        every bucket would make hundreds of series per histogram.
+        """
+        totals = {}
+        for index, count in self.counts.items():
+            octave = index // self.sub_buckets
+            totals[octave] = totals.get(octave, 0) + count
+
+        cumulative = 0
+        result = []
+        for octave in sorted(totals):
+            cumulative += totals[octave]
+            result.append(((self.sub_buckets << octave) * self.unit,
+                           cumulative))
+        return result
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'min': self.min or 0.0,
+            'max': self.max or 0.0,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'p999': self.percentile(99.9)
+        }
+
+
+def format_value(value):
+    """
+    Returns a number as the Prometheus text format writes it.
+    """
+    if isinstance(value, (int, long)):
+        return str(value)
+
+    # Bucket bounds are multiples of a unit like 1e-6, which floats can't
+    # hold exactly.
+    return repr(round(value, 9))
+
+
+class Metrics(object):
+    """
+    Counters, gauges and histograms for one layer of one connection.
+
+    Counters and gauges share the `values` dict, which is what the layer
+    reports as its statistics. Gauges can also be functions, worked out
+    whenever a snapshot is taken. Every name is exported with `prefix` in
+    front and `labels` attached.
+    """
+
+    def __init__(self, prefix, labels=None):
+        self.prefix = prefix
+        self.labels = labels or {}
+
+        self.values = {}
+        self.kinds = {}
+        self.gauge_funcs = {}
+        self.histograms = {}
+
+        self.lock = Lock()
+        self.started = time.time()
+
+    def counter(self, name, value=0):
+        self.values[name] = value
+        self.kinds[name] = 'counter'
+
+    def gauge(self, name, value=0.0):
+        self.values[name] = value
+        self.kinds[name] = 'gauge'
+
+    def gauge_func(self, name, func):
+        self.gauge_funcs[name] = func
+
+    def histogram(self, name, unit):
+        self.histograms[name] = Histogram(unit)
+
+    def count(self, name, n=1):
+        """
+        Add n to a counter.
+        """
+        with self.lock:
+            self.values[name] += n
+
+    def set(self, name, value):
+        """
+        Set a gauge.
+        """
+        self.values[name] = value
+
+    def observe(self, name, value):
+        """
+        Record a value in a histogram.
+        """
+        with self.lock:
+            self.histograms[name].record(value)
+
+    def uptime(self):
+        return time.time() - self.started
+
+    def snapshot(self):
+        """
+        Returns everything measured so far, as plain data.
+        """
+        with self.lock:
+            counters = dict((name, value)
+                            for name, value in self.values.items()
+                            if self.kinds.get(name) == 'counter')
+            gauges = dict((name, value)
+                          for name, value in self.values.items()
+                          if self.kinds.get(name) != 'counter')
+            histograms = dict((name, histogram.snapshot())
+                              for name, histogram in self.histograms.items())
+
+        for name, func in self.gauge_funcs.items():
+            gauges[name] = func()
+        gauges['uptime_seconds'] = self.uptime()
+
+        return {
+            'prefix': self.prefix,
+            'labels': self.labels,
+            'counters': counters,
+            'gauges': gauges,
+            'histograms': histograms
+        }
+
+    def prometheus_lines(self):
+        """
+        Yields (metric name, type, sample lines) for each metric, in the
+        Prometheus text format.
+        """
+        snapshot = self.snapshot()
+        labels = ','.join('%s="%s"' % item
+                          for item in sorted(self.labels.items()))
+
+        for kind in ('counters', 'gauges'):
+            for name, value in sorted(snapshot[kind].items()):
+                full_name = '%s_%s' % (self.prefix, name)
+                yield full_name, kind[:-1], \
+                    ['%s{%s} %s' % (full_name, labels, format_value(value))]
+
+        with self.lock:
+            histograms = [(name, histogram.buckets(), histogram.count,
+                           histogram.sum)
+                          for name, histogram in self.histograms.items()]
+
+        for name, buckets, count, total in sorted(histograms):
+            full_name = '%s_%s' % (self.prefix, name)
+            le_labels = labels + ',' if labels else ''
+            lines = ['%s_bucket{%sle="%s"} %d' % (full_name, le_labels,
+                                                  format_value(bound),
+                                                  cumulative)
+                     for bound, cumulative in buckets]
+            lines.append('%s_bucket{%sle="+Inf"} %d' % (full_name, le_labels,
+                                                        count))
+            lines.append('%s_sum{%s} %s' % (full_name, labels,
+                                            format_value(total)))
+            lines.append('%s_count{%s} %d' % (full_name, labels, count))
+            yield full_name, 'histogram', lines
+
+
+class MetricsRegistry(object):
+    """
+    The metrics of every open connection in the process.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = Lock()
+
+        # Numbers connections in their metrics' labels.
+        self.connection_ids = itertools.count(1)
+
+    def next_connection_id(self):
+        return str(next(self.connection_ids))
+
+    def add(self, metrics):
+        with self.lock:
+            self.metrics.append(metrics)
+
+    def remove(self, metrics):
+        with self.lock:
+            if metrics in self.metrics:
+                self.metrics.remove(metrics)
+
+    def to_json(self):
+        with self.lock:
+            metrics = list(self.metrics)
+
+        return json.dumps([m.snapshot() for m in metrics], indent=2,
+                          sort_keys=True)
+
+    def to_prometheus(self):
+        with self.lock:
+            metrics = list(self.metrics)
+
+        # Each metric's type is declared once, above the samples from every
+        # connection.
+        types = {}
+        samples = {}
+        for m in metrics:
+            for name, kind, lines in m.prometheus_lines():
+                types[name] = kind
+                samples.setdefault(name, []).extend(lines)
+
+        text = []
+        for name in sorted(samples):
+            text.append('# TYPE %s %s' % (name, types[name]))
+            text.extend(samples[name])
+        return '\n'.join(text) + '\n'
+
+    def export(self, format):
+        if format == 'json':
+            return self.to_json()
+        else:
+            return self.to_prometheus()
+
+
+class MetricsExporter(object):
+    """
+    Publishes the registry's metrics as JSON or Prometheus text.
+
+    A target of the form host:port is served over HTTP: each request gets a
+    fresh snapshot, so Prometheus can scrape it. Any other target is a file,
+    rewritten every `interval` seconds.
+    """
+
+    def __init__(self, registry, target, format='prometheus',
+                 interval=DEFAULT_METRICS_INTERVAL):
+        self.registry = registry
+        self.target = target
+        self.format = format
+        self.interval = interval
+
+        host, _, port = target.rpartition(':')
+        if host and port.isdigit():
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host, int(port)))
+            self.sock.listen(LISTEN_BACKLOG)
+            thread_func = self.serve_thread_func
+        else:
+            self.sock = None
+            thread_func = self.file_thread_func
+
+        self.thread = Thread(target=thread_func)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def write_file(self):
+        """
+        Replace the file with a snapshot, all at once, so readers never see
+        half of one.
+        """
+        temporary = self.target + '.tmp'
+        with open(temporary, 'w') as f:
+            f.write(self.registry.export(self.format))
+        os.rename(temporary, self.target)
+
+    def file_thread_func(self):
+        while True:
+            try:
+                self.write_file()
+            except Exception:
+                traceback.print_exc()
+            time.sleep(self.interval)
+
+    def serve_thread_func(self):
+        if self.format == 'json':
+            content_type = 'application/json'
+        else:
+            content_type = 'text/plain; version=0.0.4'
+
+        while True:
+            conn, _ = self.sock.accept()
+            try:
+                # The request itself doesn't matter.
+                conn.recv(4096)
+                body = self.registry.export(self.format)
+                conn.sendall('HTTP/1.0 200 OK\r\n'
+                             'Content-Type: %s\r\n'
+                             'Content-Length: %d\r\n\r\n%s' %
+                             (content_type, len(body), body))
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+
+# The registry every connection in the process adds its metrics to.
+registry = MetricsRegistry()
@@ -1,17 +1,41 @@
+import errno
+import heapq
 import socket
-import random
 import time
 
-from threading import Thread
+from Queue import Queue, Empty
+from threading import Thread, Condition, Lock
 
+from buffers import ReceiveBuffer
+from impairment import Impairment
+from metrics import Metrics
+from reactor import reactor as default_reactor
+from timers import scheduler
 from utils import *
 
 
 class PhysicalLayer(object):
+    # Kind of socket frames travel over.
+    socket_type = socket.SOCK_STREAM
 
-    def __init__(self, drop_rate, corrupt_rate):
+    # Whether each frame arrives as a datagram of its own, rather than as
+    # part of a byte stream.
+    datagrams = False
+
+    # Whether a reactor reads the socket and calls the data-link layer back,
+    # rather than a receive thread of our own filling a buffer it reads.
+    evented = False
+
+    # Whether to tell the user when the other end goes away. A server with
+    # many clients doesn't.
+    announce_end = True
+
+    def __init__(self, drop_rate, corrupt_rate,
+                 flush_bytes=DEFAULT_FLUSH_BYTES,
+                 flush_delay=DEFAULT_FLUSH_DELAY, nodelay=True,
+                 impairment=None, seed=None):
         # Create a socket.
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock = socket.socket(socket.AF_INET, self.socket_type)
 
         # Set SO_REUSEADDR option.
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -22,99 +46,234 @@ class PhysicalLayer(object):
         # Store frame corrupt rate.
         self.corrupt_rate = float(corrupt_rate) / 100
 
+        # Decides which frames are lost, corrupted or held back. By default
+        # frames are lost and corrupted independently at the rates above.
+        self.impairment = impairment or \
+            Impairment(drop_rate, corrupt_rate, seed=seed)
+
         # The receive thread will constantly put things in this buffer.
-        self.received_data_buffer = ""
+        self.received_data_buffer = ReceiveBuffer()
+
+        # Preallocated chunk the receive thread reads the socket into.
+        self.recv_chunk = bytearray(RECV_CHUNK_SIZE)
+
+        # Frames waiting for the send thread, and their total size.
+        self.send_queue = []
+        self.send_queue_bytes = 0
+        self.send_condition = Condition()
+
+        # Frames held back by the impairment, as a heap of (time to send,
+        # order queued, frame).
+        self.delayed = []
+        self.delayed_count = 0
+
+        # The send thread waits up to `flush_delay` seconds for more frames
+        # to join a batch, unless `flush_bytes` are already queued.
+        self.flush_bytes = flush_bytes
+        self.flush_delay = flush_delay
+
+        # Whether to disable Nagle's algorithm on the connected socket.
+        self.nodelay = nodelay
+
+        # Set once the connection is over and nothing more will be sent.
+        self.closed = False
+
+        # What the data-link layer handed down, what the impairment did to
+        # it, and the bytes which actually crossed the socket.
+        self.metrics = Metrics('physical')
+        for name in ('frames_sent', 'frames_dropped', 'frames_corrupted',
+                     'frames_delayed', 'bytes_sent', 'bytes_received'):
+            self.metrics.counter(name)
+        self.metrics.histogram('impairment_delay_seconds',
+                               HISTOGRAM_TIME_UNIT)
 
         debug_log("Frame drop rate: %s." % self.drop_rate)
         debug_log("Frame corrupt rate: %s." % self.corrupt_rate)
 
     def receive_thread_func(self):
-        while True:
-            got = self.sock.recv(128)
+        chunk_view = memoryview(self.recv_chunk)
 
-            if got == '':
-                print "Connection ended. Nothing to do. Ctrl-C to exit."
+        while True:
+            try:
+                got = self.sock.recv_into(self.recv_chunk)
+            except socket.error:
+                # Reset, or closed from this end.
+                got = 0
+
+            if got == 0:
+                self.received_data_buffer.close()
+                if not self.closed and self.announce_end:
+                    print "Connection ended. Nothing to do. Ctrl-C to exit."
                 exit(0)
 
-            self.received_data_buffer += got
-            time.sleep(0.001)
+            self.metrics.count('bytes_received', got)
+            self.received_data_buffer.write(chunk_view[:got])
 
-    def decide_to_drop(self):
-        """
-        Returns True, at a probablity configured by the --drop command line
-        parameter.
-        """
+    def send_thread_func(self):
+        while True:
+            with self.send_condition:
+                while not self.release_delayed():
+                    if self.closed:
+                        return
+                    self.send_condition.wait(self.delayed[0][0] - time.time()
+                                             if self.delayed else None)
+
+                # Give more frames a chance to join this batch.
+                if self.flush_delay and \
+                        self.send_queue_bytes < self.flush_bytes:
+                    self.send_condition.wait(self.flush_delay)
 
-        # Don't give a chance to drop if rate is 0.0.
-        if self.drop_rate == 0.0:
-            return False
+                frames, self.send_queue = self.send_queue, []
+                self.send_queue_bytes = 0
 
-        return random.random() < self.drop_rate
+            self.write_frames(frames)
 
-    def maybe_corrupt(self, data):
+    def release_delayed(self):
         """
-        Returns `data` back, possibly with one byte changed, at a probability
-        configured by the --corrupt command line parameter.
+        Move held back frames whose time has come onto the send queue.
+        Returns True if there is anything to send. The send condition must
+        be held.
         """
+        now = time.time()
+        while self.delayed and self.delayed[0][0] <= now:
+            data = heapq.heappop(self.delayed)[2]
+            self.send_queue.append(data)
+            self.send_queue_bytes += len(data)
 
-        # Don't give it a chance to corrupt if rate is 0.0.
-        if self.corrupt_rate == 0.0:
-            return data
+        return bool(self.send_queue)
 
-        # If random doesn't pass rate, then return without corrupting.
-        if random.random() > self.corrupt_rate:
-            return data
-
-        # Select data index to corrupt.
-        corrupt_index = random.randint(0, len(data) - 1)
+    def write_frames(self, frames):
+        """
+        Write a batch of frames to the socket.
+        """
 
-        # Generate corrupted byte.
-        corrupt_byte = chr(random.randint(0, 255))
+        # Python 2 sockets have no sendmsg, so gather the batch into one
+        # buffer and write it with a single call.
+        batch = bytearray().join(frames)
+        try:
+            self.sock.sendall(batch)
+        except socket.error:
+            # The other end has gone. The receive thread will see it too.
+            return
 
-        # Corrupt the data and return it.
-        c_data = list(data)
-        c_data[corrupt_index] = corrupt_byte
-        c_data = "".join(c_data)
+        self.metrics.count('bytes_sent', len(batch))
 
-        return c_data
+    def impaired_delay(self, delay):
+        """
+        Record a frame the impairment is holding back for `delay` seconds.
+        """
+        self.metrics.count('frames_delayed')
+        self.metrics.observe('impairment_delay_seconds', delay)
 
     def start_receive_thread(self):
         self.receive_thread = Thread(target=self.receive_thread_func)
         self.receive_thread.setDaemon(True)
         self.receive_thread.start()
 
-    def send(self, data):
+    def start_send_thread(self):
+        self.send_thread = Thread(target=self.send_thread_func)
+        self.send_thread.setDaemon(True)
+        self.send_thread.start()
+
+    def connected(self):
         """
-        Send data through the physical layer.
+        Configure the connected socket and launch the worker threads.
         """
+        if self.nodelay:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        # Maybe drop and return immediately.
-        if self.decide_to_drop():
-            return
+        self.start_receive_thread()
+        self.start_send_thread()
 
-        # Maybe corrupt the data.
-        data = self.maybe_corrupt(data)
+    def send(self, data):
+        """
+        Queue data to be sent through the physical layer.
+        """
 
-        # Send it.
-        self.sock.sendall(data)
+        with self.send_condition:
+            # Maybe drop and return immediately. Everything is dropped once
+            # the connection is closed.
+            self.metrics.count('frames_sent')
+            if self.closed or self.impairment.decide_to_drop():
+                self.metrics.count('frames_dropped')
+                return
+
+            # Maybe corrupt the data.
+            corrupted = self.impairment.maybe_corrupt(data)
+            if corrupted is not data:
+                self.metrics.count('frames_corrupted')
+                data = corrupted
+
+            # Maybe hold it back, waking the send thread in case it is now
+            # the first due.
+            now = time.time()
+            delay = self.impairment.delay_for(len(data), now)
+            if delay > 0:
+                self.impaired_delay(delay)
+                heapq.heappush(self.delayed,
+                               (now + delay, self.delayed_count, data))
+                self.delayed_count += 1
+                self.send_condition.notify()
+                return
+
+            # Queue it for the send thread.
+            was_empty = not self.send_queue
+            self.send_queue.append(data)
+            self.send_queue_bytes += len(data)
+
+            # Only wake the send thread when it has something new to do:
+            # the queue was idle, or a batch is big enough to flush now.
+            if was_empty or self.send_queue_bytes >= self.flush_bytes:
+                self.send_condition.notify()
+
+    def close(self):
+        """
+        Stop sending, and close the socket.
+        """
+        with self.send_condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.send_condition.notify()
+
+        # Closing alone leaves the socket open while the receive thread is
+        # blocked reading it, so the other end would never hear. Shutting it
+        # down wakes the thread and sends the end of the stream.
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            # Never connected, or already gone.
+            pass
+        self.sock.close()
 
     def recv(self, n):
         """
         Receive up to n bytes of data from the physical layer.
         """
 
-        # Block until enough data is available.
-        while len(self.received_data_buffer) < n:
-            pass
+        # Blocks until enough data is available.
+        return self.received_data_buffer.read(n)
 
-        to_return, self.received_data_buffer = \
-            self.received_data_buffer[:n], self.received_data_buffer[n:]
+    def recv_available(self, n):
+        """
+        Receive everything buffered so far, waiting for at least n bytes.
+        """
+
+        # Blocks until enough data is available.
+        return self.received_data_buffer.read_available(n)
 
-        return to_return
+    def wait_for_data(self, timeout):
+        """
+        Wait up to `timeout` seconds for data to arrive, or for the other
+        end to finish.
+        """
+        with self.received_data_buffer.condition:
+            self.received_data_buffer.wait_for(1, timeout)
 
 class PhysicalLayer_Client(PhysicalLayer):
-    def __init__(self, drop_rate, corrupt_rate):
-        super(PhysicalLayer_Client, self).__init__(drop_rate, corrupt_rate)
+    def __init__(self, drop_rate, corrupt_rate, **kwargs):
+        super(PhysicalLayer_Client, self).__init__(drop_rate, corrupt_rate,
+                                                   **kwargs)
 
         # Connect to server.
         try:
@@ -124,13 +283,14 @@ class PhysicalLayer_Client(PhysicalLayer):
             sys.exit(0)
         debug_log("Physical Layer client started.")
 
-        # Launch the receiving thread.
-        self.start_receive_thread()
+        # Launch the receiving and sending threads.
+        self.connected()
 
 
 class PhysicalLayer_Server(PhysicalLayer):
-    def __init__(self, drop_rate, corrupt_rate):
-        super(PhysicalLayer_Server, self).__init__(drop_rate, corrupt_rate)
+    def __init__(self, drop_rate, corrupt_rate, **kwargs):
+        super(PhysicalLayer_Server, self).__init__(drop_rate, corrupt_rate,
+                                                   **kwargs)
 
         # Bind socket.
         self.sock.bind(SERVER_ADDRESS)
@@ -144,5 +304,413 @@ class PhysicalLayer_Server(PhysicalLayer):
         self.sock, self.remote_addr = self.sock.accept()
         debug_log("Accepted connection from %s." % str(self.remote_addr))
 
-        # Launch the receiving thread.
+        # Launch the receiving and sending threads.
+        self.connected()
+
+
+class PhysicalLayer_Connected(PhysicalLayer):
+    """
+    Runs over a socket which is already connected, such as one a Listener
+    has accepted.
+    """
+    announce_end = False
+
+    def __init__(self, drop_rate, corrupt_rate, sock, **kwargs):
+        super(PhysicalLayer_Connected, self).__init__(drop_rate, corrupt_rate,
+                                                      **kwargs)
+
+        # Use the connected socket in place of a fresh one.
+        self.sock.close()
+        self.sock = sock
+
+        # Launch the receiving and sending threads.
+        self.connected()
+
+
+class PhysicalLayer_Evented(PhysicalLayer):
+    """
+    Runs over a connected stream socket without any threads of its own. A
+    Reactor reads the socket as data arrives and writes it as it drains, and
+    the data-link layer decodes frames from the reactor's thread as soon as
+    they are buffered. Frames held back by the impairment are sent from the
+    timer thread.
+    """
+    evented = True
+
+    def __init__(self, drop_rate, corrupt_rate, sock,
+                 reactor=default_reactor, **kwargs):
+        super(PhysicalLayer_Evented, self).__init__(drop_rate, corrupt_rate,
+                                                    **kwargs)
+
+        # Use the connected socket in place of a fresh one, without
+        # blocking on it.
+        self.sock.close()
+        self.sock = sock
+        self.sock.setblocking(False)
+
+        if self.nodelay and sock.family == socket.AF_INET:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        # Bytes sent but not yet taken by the socket, and whether the
+        # reactor has been asked to say when it will take more.
+        self.outgoing = bytearray()
+        self.outgoing_lock = Lock()
+        self.writing = False
+
+        # The data-link layer to call back as data arrives, once it has
+        # taken over from any handshake.
+        self.protocol = None
+
+        self.reactor = reactor
+        self.reactor.register(self)
+
+    def attach(self, protocol):
+        """
+        Call `protocol.data_received()` whenever data arrives or the
+        connection ends, starting with whatever is buffered already.
+        """
+        self.protocol = protocol
+        protocol.data_received()
+
+    def on_readable(self):
+        """
+        Called by the reactor once the socket has data, or has ended.
+        """
+        if self.closed:
+            return
+
+        chunk_view = memoryview(self.recv_chunk)
+
+        while True:
+            try:
+                got = self.sock.recv_into(self.recv_chunk)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+
+                # Reset.
+                got = 0
+
+            if got == 0:
+                self.reactor.unregister(self)
+                self.received_data_buffer.close()
+                break
+
+            self.metrics.count('bytes_received', got)
+            self.received_data_buffer.write(chunk_view[:got])
+
+            # Anything more will have to wait for the next poll.
+            if got < len(self.recv_chunk):
+                break
+
+        if self.protocol is not None:
+            self.protocol.data_received()
+
+    def on_writable(self):
+        """
+        Called by the reactor once the socket will take more.
+        """
+        with self.outgoing_lock:
+            self.flush()
+
+    def flush(self):
+        """
+        Write as much as the socket will take without blocking, and have the
+        reactor say when it will take the rest. The outgoing lock must be
+        held.
+        """
+        while self.outgoing:
+            try:
+                sent = self.sock.send(self.outgoing)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+
+                # The other end has gone. The reactor will see it too.
+                del self.outgoing[:]
+                break
+
+            del self.outgoing[:sent]
+            self.metrics.count('bytes_sent', sent)
+
+        writing = bool(self.outgoing) and not self.closed
+        if writing != self.writing:
+            self.writing = writing
+            self.reactor.want_write(self, writing)
+
+    def write_frames(self, frames):
+        with self.outgoing_lock:
+            for frame in frames:
+                self.outgoing += frame
+            self.flush()
+
+    def send(self, data):
+        """
+        Send data through the physical layer, straight away unless the
+        impairment holds it back.
+        """
+        with self.send_condition:
+            # Maybe drop and return immediately. Everything is dropped once
+            # the connection is closed.
+            self.metrics.count('frames_sent')
+            if self.closed or self.impairment.decide_to_drop():
+                self.metrics.count('frames_dropped')
+                return
+
+            # Maybe corrupt the data.
+            corrupted = self.impairment.maybe_corrupt(data)
+            if corrupted is not data:
+                self.metrics.count('frames_corrupted')
+                data = corrupted
+
+            # Maybe hold it back.
+            delay = self.impairment.delay_for(len(data), time.time())
+
+        if delay > 0:
+            self.impaired_delay(delay)
+            scheduler.schedule(delay, self.write_frames, [data])
+        else:
+            self.write_frames([data])
+
+    def close(self):
+        """
+        Stop sending, and close the socket.
+        """
+        with self.send_condition:
+            if self.closed:
+                return
+            self.closed = True
+
+        self.reactor.unregister(self)
+        self.sock.close()
+
+
+class Listener(object):
+    """
+    Accepts connections from any number of clients, each of which gets a
+    physical layer of its own.
+
+    With `reuse_port` set, several processes may each listen on the server
+    address, and the kernel shares new connections out between them.
+    """
+
+    def __init__(self, reuse_port=False, backlog=LISTEN_BACKLOG):
+        # Create a socket.
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+        # Set SO_REUSEADDR option, and SO_REUSEPORT if asked.
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+        # Bind socket.
+        self.sock.bind(SERVER_ADDRESS)
+
+        # Start listening.
+        self.sock.listen(backlog)
+
+        debug_log("Server listening...")
+
+    def accept(self):
+        """
+        Block until a client connects, and return its socket and address.
+        Nothing is started for it until `adopt` is called.
+        """
+        sock, remote_addr = self.sock.accept()
+        debug_log("Accepted connection from %s." % str(remote_addr))
+        return sock, remote_addr
+
+
+def adopt(sock, remote_addr, drop_rate, corrupt_rate, reactor=None, **kwargs):
+    """
+    Returns a physical layer for a client a Listener has accepted. Given a
+    reactor, the connection is served from its thread instead of threads of
+    its own.
+    """
+    if reactor is not None:
+        physical_layer = PhysicalLayer_Evented(drop_rate, corrupt_rate, sock,
+                                               reactor=reactor, **kwargs)
+    else:
+        physical_layer = PhysicalLayer_Connected(drop_rate, corrupt_rate, sock,
+                                                 **kwargs)
+    physical_layer.remote_addr = remote_addr
+    return physical_layer
+
+
+class PhysicalLayer_UDP(PhysicalLayer):
+    """
+    Sends each frame as a UDP datagram of its own. There is no
+    retransmission or reordering underneath the data-link layer, and every
+    datagram received is one whole frame.
+    """
+    socket_type = socket.SOCK_DGRAM
+    datagrams = True
+
+    def __init__(self, drop_rate, corrupt_rate, **kwargs):
+        super(PhysicalLayer_UDP, self).__init__(drop_rate, corrupt_rate,
+                                                **kwargs)
+
+        # Preallocated buffer big enough for any datagram, which the receive
+        # thread reads each one into.
+        self.recv_chunk = bytearray(MAX_DATAGRAM_SIZE)
+        self.recv_view = memoryview(self.recv_chunk)
+
+        # Datagrams received but not yet decoded.
+        self.received_datagrams = Queue()
+
+    def receive_thread_func(self):
+        while True:
+            try:
+                self.recv_datagram()
+            except socket.error:
+                if self.closed:
+                    return
+
+                # The other end isn't listening yet. What it sends once it
+                # is will still arrive.
+                continue
+
+    def recv_datagram(self):
+        """
+        Read one datagram from the socket and queue it, returning the
+        address it came from.
+        """
+        got, address = self.sock.recvfrom_into(self.recv_chunk)
+        self.metrics.count('bytes_received', got)
+        self.received_datagrams.put(self.recv_view[:got].tobytes())
+        return address
+
+    def write_frames(self, frames):
+        for frame in frames:
+            try:
+                self.sock.send(frame)
+            except socket.error:
+                # Nobody is listening at the other end yet, which is the
+                # same as the frame being lost.
+                continue
+
+            self.metrics.count('bytes_sent', len(frame))
+
+    def connected(self):
+        """
+        Launch the worker threads once the other end's address is known.
+        """
+        self.start_receive_thread()
+        self.start_send_thread()
+
+    def recv_datagrams(self, block, timeout=None):
+        """
+        Receive every datagram queued so far, waiting for at least one if
+        `block` is set, for up to `timeout` seconds if that is given.
+        """
+        try:
+            datagrams = [self.received_datagrams.get(block, timeout)]
+        except Empty:
+            return []
+
+        while True:
+            try:
+                datagrams.append(self.received_datagrams.get_nowait())
+            except Empty:
+                return datagrams
+
+
+class PhysicalLayer_UDPClient(PhysicalLayer_UDP):
+    def __init__(self, drop_rate, corrupt_rate, **kwargs):
+        super(PhysicalLayer_UDPClient, self).__init__(drop_rate, corrupt_rate,
+                                                      **kwargs)
+
+        # Send to and receive from the server only. Nothing is sent yet.
+        self.sock.connect(SERVER_ADDRESS)
+        debug_log("Physical Layer UDP client started.")
+
+        # Launch the receiving and sending threads.
+        self.connected()
+
+
+class PhysicalLayer_UDPServer(PhysicalLayer_UDP):
+    def __init__(self, drop_rate, corrupt_rate, **kwargs):
+        super(PhysicalLayer_UDPServer, self).__init__(drop_rate, corrupt_rate,
+                                                      **kwargs)
+
+        # Bind socket.
+        self.sock.bind(SERVER_ADDRESS)
+
+        debug_log("Server waiting for a datagram...")
+
+        # The first datagram to arrive says who the client is. From then on
+        # only talk to it.
+        self.remote_addr = self.recv_datagram()
+        self.sock.connect(self.remote_addr)
+        debug_log("Talking to %s." % str(self.remote_addr))
+
+        # Launch the receiving and sending threads.
+        self.connected()
+
+
+class PhysicalLayer_Loopback(PhysicalLayer_Connected):
+    """
+    One end of an in-process byte stream, for running both ends of a
+    connection in the same program. Frames are dropped and corrupted exactly
+    as they are over TCP.
+    """
+
+    def connected(self):
+        """
+        Launch the worker threads. There is no TCP underneath to configure.
+        """
         self.start_receive_thread()
+        self.start_send_thread()
+
+
+class PhysicalLayer_LoopbackDatagram(PhysicalLayer_UDP):
+    """
+    One end of an in-process datagram link, which delivers each frame whole
+    like UDP.
+    """
+
+    def __init__(self, drop_rate, corrupt_rate, sock, **kwargs):
+        super(PhysicalLayer_LoopbackDatagram, self).__init__(drop_rate,
+                                                             corrupt_rate,
+                                                             **kwargs)
+
+        # Use our end of the pair in place of a network socket.
+        self.sock.close()
+        self.sock = sock
+
+        # Launch the receiving and sending threads.
+        self.connected()
+
+
+def loopback_pair(drop_rate, corrupt_rate, datagrams=False, seed=None,
+                  impairments=None, reactor=None, **kwargs):
+    """
+    Returns two physical layers connected to each other within this process,
+    as (client, server). Both drop and corrupt frames at the given rates,
+    the client seeded with `seed` and the server with the next seed, unless
+    `impairments` gives each end's own. With `datagrams` set, each frame
+    arrives on its own as it would over UDP. Given a reactor, both ends of a
+    byte stream are served from its thread.
+    """
+    if reactor is not None:
+        socket_type = socket.SOCK_STREAM
+        physical_class = PhysicalLayer_Evented
+        kwargs['reactor'] = reactor
+    elif datagrams:
+        socket_type = socket.SOCK_DGRAM
+        physical_class = PhysicalLayer_LoopbackDatagram
+    else:
+        socket_type = socket.SOCK_STREAM
+        physical_class = PhysicalLayer_Loopback
+
+    if impairments is None:
+        impairments = [Impairment(drop_rate, corrupt_rate,
+                                  seed=None if seed is None else seed + i)
+                       for i in xrange(2)]
+
+    client_sock, server_sock = socket.socketpair(socket.AF_UNIX, socket_type)
+
+    return (physical_class(drop_rate, corrupt_rate, client_sock,
+                           impairment=impairments[0], **kwargs),
+            physical_class(drop_rate, corrupt_rate, server_sock,
+                           impairment=impairments[1], **kwargs))
@@ -0,0 +1,151 @@
+import os
+import errno
+import fcntl
+import select
+import traceback
+from threading import Thread, Lock
+
+
+# Poll events which mean a socket has something to read, or has ended.
+READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+
+
+class Reactor(object):
+    """
+    Waits on the sockets of every connection registered with it from a
+    single thread, and calls each one back when its socket is ready. This
+    plays the part of an asyncio event loop, which Python 2 lacks: however
+    many connections there are, none needs a thread of its own to read or
+    write, and nothing waits on a sleep.
+
+    A connection has a `sock`, and `on_readable()` and `on_writable()`
+    methods. Registering and asking to write only queue the change and wake
+    the reactor thread, which applies it before polling again, so they are
+    safe to call from any thread.
+    """
+
+    def __init__(self):
+        self.poller = select.poll()
+
+        # Registered connections, by file descriptor, and the descriptor of
+        # each.
+        self.connections = {}
+        self.filenos = {}
+
+        # Changes to make before the next poll, as (connection, events),
+        # where events of None unregisters it.
+        self.changes = []
+        self.lock = Lock()
+
+        # Pipe which wakes the reactor thread from its poll, made along with
+        # the thread.
+        self.wake_read = self.wake_write = None
+
+        self.thread = None
+
+    def start_thread(self):
+        # Writing a byte to the pipe wakes the reactor thread. Once a byte
+        # is waiting, further ones are not needed, so neither end blocks.
+        # It is made here rather than up front so that server processes
+        # forked after import each get a pipe of their own.
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, os.O_NONBLOCK)
+        self.poller.register(self.wake_read, select.POLLIN)
+
+        self.thread = Thread(target=self.thread_func)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def change(self, connection, events):
+        with self.lock:
+            if self.thread is None:
+                self.start_thread()
+
+            self.changes.append((connection, events))
+
+        self.wake()
+
+    def register(self, connection):
+        """
+        Start calling `connection` back when its socket can be read.
+        """
+        self.change(connection, READ_EVENTS)
+
+    def unregister(self, connection):
+        """
+        Stop calling `connection` back. Must be called before its socket is
+        closed.
+        """
+        self.change(connection, None)
+
+    def want_write(self, connection, writing):
+        """
+        Start or stop calling `connection` back when its socket can be
+        written.
+        """
+        self.change(connection,
+                    READ_EVENTS | select.POLLOUT if writing else READ_EVENTS)
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def apply_changes(self):
+        with self.lock:
+            changes, self.changes = self.changes, []
+
+        for connection, events in changes:
+            if events is None:
+                fileno = self.filenos.pop(connection, None)
+                if fileno is not None:
+                    self.poller.unregister(fileno)
+                    del self.connections[fileno]
+                continue
+
+            if connection not in self.filenos:
+                fileno = connection.sock.fileno()
+                self.filenos[connection] = fileno
+                self.connections[fileno] = connection
+
+            self.poller.register(self.filenos[connection], events)
+
+    def thread_func(self):
+        while True:
+            self.apply_changes()
+
+            try:
+                ready = self.poller.poll()
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fileno, events in ready:
+                if fileno == self.wake_read:
+                    try:
+                        os.read(self.wake_read, 4096)
+                    except OSError as e:
+                        if e.errno != errno.EAGAIN:
+                            raise
+                    continue
+
+                connection = self.connections.get(fileno)
+                if connection is None:
+                    continue
+
+                # One failing connection must not stop the rest.
+                try:
+                    if events & select.POLLOUT:
+                        connection.on_writable()
+                    if events & READ_EVENTS:
+                        connection.on_readable()
+                except Exception:
+                    traceback.print_exc()
+
+
+# The one reactor shared by every evented connection in the process.
+reactor = Reactor()
@@ -0,0 +1,69 @@
+from utils import *
+
+
+# Gains for the smoothed RTT and RTT variance, from Jacobson/Karels.
+SRTT_GAIN = 0.125
+RTTVAR_GAIN = 0.25
+
+
+class RttEstimator(object):
+    """
+    Tracks the round trip time of a connection and derives the
+    retransmission timeout from it, as in RFC 6298.
+    """
+
+    def __init__(self, initial_rto, ack_delay=0.0):
+        # Smoothed round trip time and its variance, in seconds. None until
+        # the first sample.
+        self.srtt = None
+        self.rttvar = None
+
+        # Current retransmission timeout, in seconds, and what it is without
+        # any backoff.
+        self.rto = initial_rto
+        self.base_rto = initial_rto
+
+        # Longest the other end may hold back an ack. Like TCP's max ack
+        # delay, it is added to the timeout, so a delayed ack isn't taken
+        # for a lost frame.
+        self.ack_delay = ack_delay
+
+    def sample(self, rtt):
+        """
+        Fold one measured round trip time into the estimate.
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += RTTVAR_GAIN * (abs(self.srtt - rtt) - self.rttvar)
+            self.srtt += SRTT_GAIN * (rtt - self.srtt)
+
+        self.base_rto = self.clamp(self.srtt + 4 * self.rttvar +
+                                   self.ack_delay)
+        self.rto = self.base_rto
+
+    def backoff(self):
+        """
+        Double the timeout after a retransmission timer fires.
+        """
+        self.rto = self.backed_off(self.rto)
+
+    def reset_backoff(self):
+        """
+        Undo any backoff once new data has been acked. Samples may never
+        come while everything in flight has been retransmitted, so without
+        this the timeout would stay backed off for good.
+        """
+        self.rto = self.base_rto
+
+    @staticmethod
+    def backed_off(timeout):
+        """
+        Returns the timeout to use after `timeout` has expired once.
+        """
+        return RttEstimator.clamp(timeout * 2)
+
+    @staticmethod
+    def clamp(timeout):
+        return max(MIN_RTO, min(timeout, MAX_RTO))
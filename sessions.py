@@ -0,0 +1,41 @@
+import traceback
+from Queue import Queue
+from threading import Thread
+
+from utils import *
+
+
+class SessionPool(object):
+    """
+    Runs each client's session on one of a fixed number of worker threads.
+    Sessions beyond that many wait their turn, so a flood of clients can't
+    start more threads than the server was sized for.
+    """
+
+    def __init__(self, session_func, max_sessions=DEFAULT_MAX_SESSIONS):
+        self.session_func = session_func
+
+        # Clients accepted but not yet being served.
+        self.waiting = Queue()
+
+        # Launch the workers.
+        for _ in xrange(max_sessions):
+            worker = Thread(target=self.worker_func)
+            worker.setDaemon(True)
+            worker.start()
+
+    def worker_func(self):
+        while True:
+            args = self.waiting.get()
+
+            # One client's failure mustn't take a worker down with it.
+            try:
+                self.session_func(*args)
+            except Exception:
+                traceback.print_exc()
+
+    def submit(self, *args):
+        """
+        Queue a session, which a worker runs as session_func(*args).
+        """
+        self.waiting.put(args)
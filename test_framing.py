@@ -0,0 +1,103 @@
+import unittest
+
+from framing import FrameDecoder, encode_frame, encode_sack, decode_sack, \
+    hello_checksum, FRAME_HEADER, DATA_FRAME, NO_PREV
+
+
+class BufferedLayer(object):
+    """
+    Stands in for a physical layer which has already received `data`.
+    """
+
+    def __init__(self, data):
+        self.data = str(data)
+
+    def recv_available(self, n):
+        data, self.data = self.data, ""
+        return data
+
+
+class FrameDecoderTest(unittest.TestCase):
+
+    def decoder(self, data):
+        return FrameDecoder(BufferedLayer(data), hello_checksum, 1024)
+
+    def test_good_frames(self):
+        data = encode_frame(1, 0, "one", hello_checksum) + \
+            encode_frame(2, 0, "two", hello_checksum, stream=3, prev=1)
+        decoder = self.decoder(data)
+
+        self.assertEqual(decoder.decode_one(block=False),
+                         (True, DATA_FRAME, 0, 1, 0, NO_PREV, "one"))
+        self.assertEqual(decoder.decode_one(block=False),
+                         (True, DATA_FRAME, 3, 2, 0, 1, "two"))
+        self.assertIsNone(decoder.decode_one(block=False))
+
+    def test_corrupt_length_then_good_frames(self):
+        bad = encode_frame(1, 0, "x" * 100, hello_checksum)
+
+        # Claim a far longer payload than follows.
+        length_offset = FRAME_HEADER.size - 2
+        bad[length_offset] ^= 0x03
+
+        data = bad + encode_frame(2, 0, "two", hello_checksum) + \
+            encode_frame(3, 0, "three", hello_checksum)
+        decoder = self.decoder(data)
+
+        # The bad frame is reported once, without waiting for the payload
+        # its length claims, and the frames after it are still found.
+        frame = decoder.decode_one(block=False)
+        self.assertFalse(frame.valid)
+        self.assertEqual(decoder.decode_one(block=False).payload, "two")
+        self.assertEqual(decoder.decode_one(block=False).payload, "three")
+        self.assertIsNone(decoder.decode_one(block=False))
+        self.assertFalse(decoder.resyncing)
+
+    def test_corrupt_payload_then_good_frame(self):
+        bad = encode_frame(1, 0, "x" * 100, hello_checksum)
+        bad[FRAME_HEADER.size + 10] ^= 0xff
+
+        decoder = self.decoder(bad + encode_frame(2, 0, "two",
+                                                  hello_checksum))
+
+        self.assertFalse(decoder.decode_one(block=False).valid)
+        frame = decoder.decode_one(block=False)
+        self.assertTrue(frame.valid)
+        self.assertEqual(frame.seq, 2)
+
+    def test_partial_frame(self):
+        data = encode_frame(1, 0, "one", hello_checksum)
+        layer = BufferedLayer(data[:-1])
+        decoder = FrameDecoder(layer, hello_checksum, 1024)
+
+        # Nothing is reported until the rest arrives.
+        self.assertIsNone(decoder.decode_one(block=False))
+        layer.data = str(data[-1:])
+        self.assertEqual(decoder.decode_one(block=False).payload, "one")
+
+
+class SackTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        received = [11, 12, 15, 20, 33]
+        bitmap = encode_sack(10, received, 64)
+
+        self.assertEqual(len(bitmap), 3)
+        self.assertEqual(list(decode_sack(10, bitmap)), received)
+
+    def test_nothing_beyond_ack(self):
+        # The cumulative ack and anything before it need no bits.
+        self.assertEqual(encode_sack(10, [9, 10], 64), "")
+        self.assertEqual(list(decode_sack(10, "")), [])
+
+    def test_truncated_at_max_len(self):
+        received = [101, 108, 116, 117, 140]
+        bitmap = encode_sack(100, received, 2)
+
+        # Only the first two bytes of bits fit.
+        self.assertEqual(len(bitmap), 2)
+        self.assertEqual(list(decode_sack(100, bitmap)), [101, 108, 116])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+import heapq
+import itertools
+import time
+import traceback
+from threading import Thread, Condition
+
+
+class TimerHandle(object):
+    """
+    A callback scheduled to run at `deadline`, unless cancelled first.
+    """
+    __slots__ = ('deadline', 'func', 'args', 'cancelled')
+
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+
+class TimerScheduler(object):
+    """
+    Runs every timer in the process from a single thread.
+
+    Timers sit in a heap ordered by deadline. Cancelling just marks the
+    handle, and the scheduler thread discards it when it reaches the top of
+    the heap, so arming and cancelling are both cheap and never create a
+    thread.
+    """
+
+    def __init__(self):
+        # Heap of (deadline, tie breaker, handle).
+        self.heap = []
+        self.counter = itertools.count()
+
+        # Signalled whenever a timer is added that may be due sooner than
+        # the one the scheduler thread is waiting for.
+        self.condition = Condition()
+
+        self.thread = None
+
+    def start_thread(self):
+        self.thread = Thread(target=self.thread_func)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def schedule(self, delay, func, *args):
+        """
+        Call func(*args) from the scheduler thread after `delay` seconds.
+        Returns a handle which can be passed to `cancel`.
+        """
+        handle = TimerHandle(time.time() + delay, func, args)
+
+        with self.condition:
+            if self.thread is None:
+                self.start_thread()
+
+            heapq.heappush(self.heap,
+                           (handle.deadline, next(self.counter), handle))
+
+            # Only wake the thread if this timer is now the earliest.
+            if self.heap[0][2] is handle:
+                self.condition.notify()
+
+        return handle
+
+    def cancel(self, handle):
+        """
+        Stop a scheduled timer from firing.
+        """
+        handle.cancelled = True
+
+    def thread_func(self):
+        while True:
+            with self.condition:
+                while True:
+                    # Sleep until there is something scheduled.
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+
+                    deadline, _, handle = self.heap[0]
+
+                    # Discard cancelled timers as they come up.
+                    if handle.cancelled:
+                        heapq.heappop(self.heap)
+                        continue
+
+                    remaining = deadline - time.time()
+                    if remaining > 0:
+                        self.condition.wait(remaining)
+                        continue
+
+                    heapq.heappop(self.heap)
+                    break
+
+            # Run the callback without holding the lock, so it can schedule
+            # further timers. One failing callback must not stop the rest.
+            try:
+                handle.func(*handle.args)
+            except Exception:
+                traceback.print_exc()
+
+
+# The one scheduler shared by every connection in the process.
+scheduler = TimerScheduler()
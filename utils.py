@@ -1,4 +1,5 @@
 import sys
+import socket
 import curses
 
 DEBUG = False
@@ -8,6 +9,16 @@ DEBUG = False
 SERVER_PORT = 8765
 SERVER_ADDRESS = ('localhost', SERVER_PORT)
 
+# Connections the server's listening socket queues before accepting them.
+LISTEN_BACKLOG = 128
+
+# Clients the server serves at once, on worker threads of each process.
+# Clients beyond these wait for a worker to free up.
+DEFAULT_MAX_SESSIONS = 16
+
+# Value of SO_REUSEPORT, which Python 2 doesn't name, on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
 # Probability, from 0 to 100, for dropping each data link frame. Default is 0.
 DEFAULT_DROP_RATE = 0
 
@@ -15,6 +26,78 @@ DEFAULT_DROP_RATE = 0
 # frame. Default is 0.
 DEFAULT_CORRUPTION_RATE = 0
 
+# Seconds a frame picked for reordering is held back, so frames sent after
+# it overtake it.
+DEFAULT_REORDER_DELAY = 0.05
+
+# Checksum algorithm used on data-link frames: 'crc32', 'adler32', or
+# 'legacy', the original byte-sum checksum.
+DEFAULT_CHECKSUM = 'crc32'
+
+# Largest data-link frame, header included, in bytes. The default leaves
+# room for IP and TCP/UDP headers within a 1500 byte Ethernet MTU.
+DEFAULT_MAX_FRAME_SIZE = 1400
+
+# Number of unacked packets each protocol allows in flight by default.
+GBN_WINDOW_LEN = 5
+SR_WINDOW_LEN = 30
+
+# Number of duplicate acks after which GBN resends its window without
+# waiting for the timer.
+DUP_ACK_THRESHOLD = 3
+
+# Seconds SR may hold back a selective ack to cover more arrivals.
+DEFAULT_ACK_DELAY = 0.0
+
+# Parity frames sent per group of data frames when forward error correction
+# is turned on.
+DEFAULT_FEC_PARITY = 1
+
+# Retransmission timeout, in seconds, used by each protocol until the first
+# round trip time has been measured.
+GBN_INITIAL_RTO = 0.3
+SR_INITIAL_RTO = 0.1
+
+# Bounds, in seconds, on the adaptive retransmission timeout.
+MIN_RTO = 0.02
+MAX_RTO = 2.0
+
+# Seconds between handshake offers while waiting for the other end, and
+# before giving up on it.
+HANDSHAKE_RETRY = 0.1
+HANDSHAKE_TIMEOUT = 30.0
+
+# Largest payload a UDP datagram can carry.
+MAX_DATAGRAM_SIZE = 65507
+
+# Number of bytes the physical layer asks the socket for in one read.
+RECV_CHUNK_SIZE = 4096
+
+# Highest data-link stream number. Streams are numbered from zero, and a
+# frame has one byte for it.
+MAX_STREAM = 255
+
+# Number of bytes of a video the server sends in one message. The data-link
+# layer splits each message across as many frames as it takes.
+STREAM_CHUNK_SIZE = 65536
+
+# Queued outbound bytes at which the physical layer flushes immediately.
+DEFAULT_FLUSH_BYTES = 16384
+
+# Seconds the physical layer may hold a frame waiting for others to batch
+# with it. Zero only batches frames that queue up during a previous write.
+DEFAULT_FLUSH_DELAY = 0.0
+
+# Buckets each power of two is split into by metrics histograms, as a power
+# of two. 5 records every value to within about 3%.
+HISTOGRAM_SUB_BITS = 5
+
+# Smallest time, in seconds, metrics histograms tell apart.
+HISTOGRAM_TIME_UNIT = 1e-6
+
+# Seconds between snapshots when metrics are exported to a file.
+DEFAULT_METRICS_INTERVAL = 1.0
+
 def debug_log(s):
     """
     Print message to standard out only if we're in verbose mode.
@@ -0,0 +1,70 @@
+class SlotWindow(object):
+    """
+    A sliding window of items keyed by sequence number.
+
+    Only sequence numbers in [base, base + capacity) can be held. Each one
+    lives in a fixed slot, at its sequence number modulo the capacity, so
+    storing, looking up and sliding the window forward are all O(1) no
+    matter how large the window is.
+    """
+
+    def __init__(self, capacity, base=0):
+        self.slots = [None] * capacity
+        self.base = base
+
+        # One past the highest sequence number stored so far.
+        self.end = base
+
+    @property
+    def capacity(self):
+        return len(self.slots)
+
+    def __len__(self):
+        """
+        Number of sequence numbers from the base up to the last one stored,
+        including any gaps.
+        """
+        return self.end - self.base
+
+    def __contains__(self, seq):
+        return self[seq] is not None
+
+    def __getitem__(self, seq):
+        """
+        Returns the item stored for `seq`, or None if there is none.
+        """
+        if not self.base <= seq < self.base + self.capacity:
+            return None
+        return self.slots[seq % self.capacity]
+
+    def __setitem__(self, seq, item):
+        if not self.base <= seq < self.base + self.capacity:
+            raise IndexError('Sequence number %d outside window.' % seq)
+
+        self.slots[seq % self.capacity] = item
+        self.end = max(self.end, seq + 1)
+
+    def append(self, item):
+        """
+        Store `item` just after the last stored sequence number.
+        """
+        self[self.end] = item
+
+    def first(self):
+        """
+        Returns the item at the base of the window, or None.
+        """
+        return self.slots[self.base % self.capacity]
+
+    def advance(self):
+        """
+        Slide the window forward by one, returning the item which was at
+        its base.
+        """
+        index = self.base % self.capacity
+        item, self.slots[index] = self.slots[index], None
+
+        self.base += 1
+        self.end = max(self.end, self.base)
+
+        return item